@@ -3,81 +3,222 @@ import os
 import numpy as np
 import gc
 
+from skimage.color import rgb2gray
+
+import segmentation
+import color_processing
 from utils import load_image, build_results_table
 from segmentation import (
     threshold_parts,
     extract_part_regions,
     sort_regions_l2r,
     regions_to_masks,
+    part_labels_to_masks,
+    part_centroids,
     compute_background
 )
 from color_processing import (
     convert_to_lab,
-    lab_normalize_from_bg,
     linear_normalize_from_bg,
-    get_lab_parts,
-    compute_metrics
+    gather_part_pixels,
+    gather_part_interiors,
+    sampled_background_mean,
+    background_lightness,
+    BG_LEVEL_STEP,
+    compute_metrics_batched
 )
-from visualization import show_results, save_numbered_parts_with_metrics
+from result_cache import DEFAULT_MAX_BYTES, image_hash, cache_key, lookup, store
+from calibration import CALIBRATION_USES, profile_bg_mask, background_drift
+from instrumentation import stage, record_value
+# matplotlib (visualization), the numbered parts drawing (annotation) and tiled_analysis are imported where they
+# are used, and pandas only loads with the first results table, so the metrics-only path starts without them
+
+MIN_AREA = 3000  # smallest area in pixels that counts as a part
+PARAMS_VERSION = 6  # bump when a change to the analysis changes its results, to invalidate cached results
+
+def analysis_params(mode='float64', downscale=1, normalized=True, calibration=None, calibration_use='apply'):
+    """
+    Collects every parameter the metrics depend on, used to key the result cache
+    INPUTS:
+    mode (str): color pipeline mode
+    downscale (int): downscale factor for the coarse segmentation pass
+    normalized (bool): whether the metrics are taken on the background normalized image (analyze_image_core) or not (analyze_image_core_batch)
+    calibration (dict): the calibration profile used, if any
+    calibration_use (str): how the calibration profile is used, 'apply' or 'verify'
+    OUTPUTS:
+    params (dict): the analysis parameters
+    """
+    params = {
+        'version': PARAMS_VERSION,
+        'min_area': MIN_AREA,
+        'coarse_percentile': segmentation.COARSE_PERCENTILE,
+        'hole_area': segmentation.HOLE_AREA,
+        'bg_percentile': segmentation.BG_PERCENTILE,
+        'highlight_percentile': color_processing.HIGHLIGHT_PERCENTILE,
+        'blackness_percentile': color_processing.BLACKNESS_PERCENTILE,
+        'red_rust': [color_processing.RED_RUST_MIN_A, color_processing.RED_RUST_MIN_B],
+        'white_rust': [*color_processing.WHITE_RUST_L, color_processing.WHITE_RUST_MAX_CHROMA],
+        'rust_edge_margin': color_processing.RUST_EDGE_MARGIN,
+        'mode': mode,
+        'downscale': downscale,
+        'normalized': normalized,
+    }
+    if calibration is not None:
+        # the drift stored with the metrics depends on the profile even when it is only verified
+        params['calibration'] = f"{calibration['id']}:{calibration_use}"
+    return params
+
+def _check_calibration_use(calibration_use):
+    if calibration_use not in CALIBRATION_USES:
+        raise ValueError(f'Unknown calibration use {calibration_use!r}, expected one of {CALIBRATION_USES}')
 
-def analyze_image_core(image_input, output_dir=None, return_fig=True):
+def _record_drift(df, drift, calibration):
+    """
+    Attaches the background drift of the frame to its metrics, so callers can flag drifted frames
+    """
+    df.attrs['background_drift'] = drift
+    df.attrs['drifted'] = drift > calibration['drift_tolerance']
+
+def analyze_image_core(image_input, output_dir=None, return_fig=True, mode='float64', downscale=1, cache_dir=None,
+                       calibration=None, calibration_use='apply', annotate=True, preview=None, pyplot=False):
     """
     Core analysis code to take an image input and output the processing timeline as well as
     response variables for the color of parts within the image. To be used by any access method.
     INPUTS:
     image_input (str): file path of the image to be analyzed
     output_dir (str): directory path to where files will be stored if desired
-    return_fig (bool): to return a annotated image or not.
+    return_fig (bool): to build and return the figure of the analysis steps or not (None is returned instead).
+    mode (str): color pipeline mode, 'float64' (reference), 'float32' or 'lut' (see PIPELINE_MODES in utils)
+    downscale (int): downscale factor for the coarse segmentation pass, 1 segments at full resolution
+    cache_dir (str): directory of the result cache, None to always analyze from scratch
+    calibration (dict): a lightbox calibration profile from calibration.load_calibration, None to find the background of every image
+    calibration_use (str): 'apply' to normalize with the profile instead of the image's own background,
+                           'verify' to only measure the drift of the background from the profile
+    annotate (bool): to render the annotated image with the part numbers or not (None is returned instead)
+    preview (int): draw the figures at most this many pixels on their longest side (ex. visualization.PREVIEW_SIZE)
+                   and the annotated image at preview resolution, None for full resolution
+    pyplot (bool): make the figure with pyplot to show it in a window (fig.show()), otherwise it is drawn on its own
+                   Agg canvas, which is safe in worker threads
 
     OUTPUTS:
-    df (pandas DataFrame): a dataframe of all the response variables
-    fig (plt Plot): a plot showing relevant graphs of the image analysis timeline
-    annotated_buf: a buffer in order for streamlit to download an image.
+    df (pandas DataFrame): a dataframe of all the response variables, with the background drift in
+                           df.attrs['background_drift'] and df.attrs['drifted'] when a calibration profile is given
+    fig (plt Plot): a plot showing relevant graphs of the image analysis timeline, None unless return_fig
+    annotated_buf: a buffer in order for streamlit to download an image, None unless annotate
     """
-    img = load_image(image_input)
+    if calibration is not None:
+        _check_calibration_use(calibration_use)
+    apply_calibration = calibration is not None and calibration_use == 'apply'
 
-    gray, binary, thresh = threshold_parts(img)
+    df = None
+    if cache_dir is not None:
+        with stage('cache'):
+            key = cache_key(image_hash(image_input), analysis_params(mode, downscale, calibration=calibration,
+                                                                     calibration_use=calibration_use))
+            df, cached_labels = lookup(cache_dir, key, need_labels=True)
+        if df is not None and not (return_fig or annotate):
+            # nothing to draw, so the image is not even loaded
+            return df, None, None
 
-    labels, regions = extract_part_regions(binary, min_area=3000)
-    regions_sorted = sort_regions_l2r(regions)
-    part_masks = regions_to_masks(labels, regions_sorted)
-    
-    bg_mask = compute_background(gray, part_masks)
-    
-    norm_img = linear_normalize_from_bg(img, bg_mask)
-    
-    L, a, b = convert_to_lab(norm_img)
+    with stage('load'):
+        img = load_image(image_input, mode=mode)
+
+    if df is not None:
+        # cached: segmentation and metrics are skipped, only what the figures need is rebuilt
+        with stage('threshold'):
+            gray = rgb2gray(img)
+            thresh = np.percentile(gray, segmentation.COARSE_PERCENTILE)
+        with stage('masks'):
+            part_masks = part_labels_to_masks(cached_labels)
+            binary = part_masks.labels > 0
+            centroids = part_centroids(part_masks)
+        with stage('background'):
+            if apply_calibration:
+                bg_mask = profile_bg_mask(calibration, part_masks)
+            else:
+                bg_mask = compute_background(gray, part_masks)
+        blackness = df['Blackness'].tolist()
+    else:
+        with stage('threshold'):
+            gray, binary, thresh = threshold_parts(img, downscale=downscale, min_area=MIN_AREA)
+
+        with stage('regions'):
+            labels, regions = extract_part_regions(binary, min_area=MIN_AREA)
+            regions_sorted = sort_regions_l2r(regions)
+            # the figures number the parts at the centroids segmentation already found
+            centroids = [r.centroid for r in regions_sorted]
+        with stage('masks'):
+            part_masks = regions_to_masks(labels, regions_sorted)
+        
+        with stage('background'):
+            correction = None
+            if apply_calibration:
+                # the fixed lightbox correction replaces finding the background of this image
+                bg_mask = profile_bg_mask(calibration, part_masks)
+                correction = calibration['correction']
+            else:
+                bg_mask = compute_background(gray, part_masks)
+            if calibration is not None:
+                drift = background_drift(img, calibration, part_masks)
+                record_value('bg_drift', drift)
 
-    #lab_norm_parts = lab_normalize_from_bg(L, a, b, bg_mask, part_masks) -- removed as it increases error
-    lab_parts = get_lab_parts(L, a, b, part_masks) # in use instead of lab_norm_parts
+        # only the part pixels are normalized and converted to Lab, the rest of the frame is never used
+        with stage('normalize'):
+            part_pixels, part_sizes = gather_part_pixels(img, part_masks)
+            interior = gather_part_interiors(part_masks)
+            norm_pixels = linear_normalize_from_bg(img, bg_mask, pixels=part_pixels, mode=mode, correction=correction)
+        
+        with stage('lab'):
+            L, a, b = convert_to_lab(norm_pixels, mode=mode)
 
-    blackness, color_shift, a_shift, b_shift, gloss = compute_metrics(lab_parts)
+        #lab_norm_parts = lab_normalize_from_bg(L, a, b, bg_mask, part_masks) -- removed as it increases error
+        # the metrics are computed straight from the gathered pixels instead of per part lists from split_lab_parts
+        with stage('metrics'):
+            metrics = compute_metrics_batched(L, a, b, part_sizes, interior=interior)
+            blackness = metrics[0]
 
-    df = build_results_table(blackness, color_shift, a_shift, b_shift, gloss)
+        with stage('table'):
+            df = build_results_table(*metrics)
+            if calibration is not None:
+                _record_drift(df, drift, calibration)
+
+        if cache_dir is not None:
+            with stage('cache'):
+                store(cache_dir, key, df, part_masks.labels)
 
     combined_save_path = None
     if output_dir is not None:
         combined_save_path = os.path.join(output_dir, 'Results.png')
     
-    fig = show_results(
-        img,
-        gray,
-        thresh,
-        binary,
-        part_masks,
-        bg_mask,
-        save_path=combined_save_path,
-        return_fig=True
-    )
-    annotated_buf = io.BytesIO()
-    save_numbered_parts_with_metrics(img, part_masks, blackness, annotated_buf)
-    annotated_buf.seek(0)
+    fig = None
+    annotated_buf = None
+    with stage('figures'):
+        if return_fig:
+            from visualization import show_results
+            fig = show_results(
+                img,
+                gray,
+                thresh,
+                binary,
+                part_masks,
+                bg_mask,
+                save_path=combined_save_path,
+                return_fig=True,
+                centroids=centroids,
+                preview=preview,
+                pyplot=pyplot
+            )
+        if annotate:
+            from annotation import save_numbered_parts_with_metrics
+            annotated_buf = io.BytesIO()
+            save_numbered_parts_with_metrics(img, part_masks, blackness, annotated_buf, centroids=centroids, preview=preview)
+            annotated_buf.seek(0)
 
     to_delete = [
         'img', 'gray', 'binary', 'thresh',
         'labels', 'regions', 'regions_sorted',
-        'part_masks', 'bg_mask', 'norm_img',
-        'L', 'a', 'b', 'lab_parts',
+        'part_masks', 'bg_mask', 'part_pixels', 'norm_pixels',
+        'L', 'a', 'b',
         'blackness', 'color_shift', 'a_shift', 'b_shift', 'gloss'
     ]
 
@@ -89,33 +230,149 @@ def analyze_image_core(image_input, output_dir=None, return_fig=True):
 
     return df, fig, annotated_buf
 
-def analyze_image_core_batch(image_input):
+def analyze_image_core_batch(image_input, mode='float64', downscale=1,
+                             cache_dir=None, cache_labels=False, cache_max_bytes=DEFAULT_MAX_BYTES,
+                             calibration=None, calibration_use='apply', image=None,
+                             annotation_path=None, annotation_size=None, memory_budget=None):
     """
-    Batch-only core: no figures, no buffers, just metrics.
+    Batch-only core: no figures, no buffers, just metrics (and optionally the numbered parts image).
+    mode (str): color pipeline mode, 'float64' (reference), 'float32' or 'lut' (see PIPELINE_MODES in utils)
+    downscale (int): downscale factor for the coarse segmentation pass, 1 segments at full resolution
+    cache_dir (str): directory of the result cache, None to always analyze from scratch
+    cache_labels (bool): also store the part label image in the cache
+    cache_max_bytes (int): size cap of the cache, least recently used entries are evicted past it
+    calibration (dict): a lightbox calibration profile, the background drift of the image is measured against it
+                        and attached to the metrics (df.attrs['background_drift'] and df.attrs['drifted'])
+    calibration_use (str): 'apply' to take the lightness of the background the white rust range is scaled to from
+                           the profile instead of the image, 'verify' to only measure the drift. The batch metrics
+                           are taken on the un-normalized image either way
+    image (numpy Array): image_input already decoded with imread, ex. by a read-ahead stage
+    annotation_path (str): file path to save the numbered parts image to (.jpg or .png), None to not draw it
+    annotation_size (int): longest side in pixels of the numbered parts image, None for full resolution
+    memory_budget (int): analyze the image a band of rows at a time within this many bytes (see tiled_analysis),
+                         for very large images. The metrics are the same, downscale must be 2 or more and
+                         calibration, annotation and cached part labels are not available.
     """
-    img = load_image(image_input)
-
-    gray, binary, thresh = threshold_parts(img)
-    labels, regions = extract_part_regions(binary, min_area=3000)
-    regions_sorted = sort_regions_l2r(regions)
-    part_masks = regions_to_masks(labels, regions_sorted)
-    bg_mask = compute_background(gray, part_masks)
-    norm_img = linear_normalize_from_bg(img, bg_mask)
-    L, a, b = convert_to_lab(img)
-    #lab_parts = lab_normalize_from_bg(L, a, b, bg_mask, part_masks) -- removed as it increases error
-    lab_parts = get_lab_parts(L, a, b, part_masks) # in use instead of lab_norm_parts
-    blackness, color_shift, a_shift, b_shift, gloss = compute_metrics(lab_parts)
-    df = build_results_table(blackness, color_shift, a_shift, b_shift, gloss)
-
-    # free big arrays before returning
-    del img, gray, binary, thresh
-    del labels, regions, regions_sorted, part_masks, bg_mask
-    del L, a, b, lab_parts
-    del norm_img
-    del blackness, color_shift, a_shift, b_shift, gloss
-    gc.collect()
+    if calibration is not None:
+        _check_calibration_use(calibration_use)
+    if memory_budget is not None and (calibration is not None or annotation_path is not None):
+        raise ValueError('Calibration and annotation need the whole image in memory, they cannot be used with a memory budget')
+    # the numbered parts image of a cached result is drawn from the cached part labels
+    cache_labels = cache_labels or annotation_path is not None
+    if cache_dir is not None:
+        with stage('cache'):
+            digest = image_hash(image_input)
+            key = cache_key(digest, analysis_params(mode, downscale, normalized=False, calibration=calibration,
+                                                    calibration_use=calibration_use))
+            df, cached_labels = lookup(cache_dir, key, need_labels=annotation_path is not None)
+        if df is not None:
+            df.attrs['image_hash'] = digest
+            if annotation_path is not None:
+                from annotation import save_numbered_parts_with_metrics
+                with stage('load'):
+                    img = load_image(image if image is not None else image_input, mode=mode)
+                with stage('annotation'):
+                    save_numbered_parts_with_metrics(img, part_labels_to_masks(cached_labels), df['Blackness'].tolist(),
+                                                     annotation_path, preview=annotation_size)
+            return df
+
+    if memory_budget is not None:
+        from tiled_analysis import analyze_image_tiled
+        df = analyze_image_tiled(image if image is not None else image_input, normalized=False, mode=mode,
+                                 downscale=downscale, min_area=MIN_AREA, memory_budget=memory_budget)
+        if cache_dir is not None:
+            df.attrs['image_hash'] = digest
+            with stage('cache'):
+                # the same metrics as the in-memory path, so they share its cache entries (without part labels)
+                store(cache_dir, key, df, None, max_bytes=cache_max_bytes)
+        return df
+
+    with stage('load'):
+        img = load_image(image if image is not None else image_input, mode=mode)
+
+    part_masks, regions_sorted, metrics, drift = _measure_parts(img, mode, downscale, calibration, calibration_use)
+    with stage('table'):
+        df = build_results_table(*metrics)
+        if calibration is not None:
+            _record_drift(df, drift, calibration)
+
+    if cache_dir is not None:
+        # the hash is already known, so the batch writer does not have to hash the image again
+        df.attrs['image_hash'] = digest
+        with stage('cache'):
+            store(cache_dir, key, df, part_masks.labels if cache_labels else None, max_bytes=cache_max_bytes)
+
+    if annotation_path is not None:
+        from annotation import save_numbered_parts_with_metrics
+        with stage('annotation'):
+            save_numbered_parts_with_metrics(img, part_masks, metrics[0], annotation_path,
+                                             centroids=[r.centroid for r in regions_sorted], preview=annotation_size)
 
+    # the arrays hold no reference cycles, so they are freed on return without a gc.collect() per image
     return df
 
 
-                                                                      
\ No newline at end of file
+                                                                      
+def _measure_parts(img, mode, downscale, calibration=None, calibration_use='apply'):
+    """
+    Segmentation and metrics of analyze_image_core_batch, without the table
+    OUTPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    regions_sorted (list): the part regions sorted left to right
+    metrics (tuple): blackness, color shift, median a*, median b*, gloss and red and white rust fractions of each part
+    drift (float): the background drift from the calibration profile, None without one
+    """
+    with stage('threshold'):
+        gray, binary, thresh = threshold_parts(img, downscale=downscale, min_area=MIN_AREA)
+    with stage('regions'):
+        labels, regions = extract_part_regions(binary, min_area=MIN_AREA)
+        regions_sorted = sort_regions_l2r(regions)
+    with stage('masks'):
+        part_masks = regions_to_masks(labels, regions_sorted)
+    # the metrics are un-normalized, the background only sets the level of the white rust L* range: an applied
+    # calibration profile gives it, otherwise a sample of the image's own background is enough
+    drift = None
+    with stage('background'):
+        if calibration is not None and calibration_use == 'apply':
+            bg_L = background_lightness(calibration['bg_mean'])
+        else:
+            grid = (slice(None, None, BG_LEVEL_STEP), slice(None, None, BG_LEVEL_STEP))
+            bg_L = background_lightness(sampled_background_mean(img[grid], gray[grid], part_masks.labels[grid] > 0))
+        if calibration is not None:
+            drift = background_drift(img, calibration, part_masks)
+            record_value('bg_drift', drift)
+    # the batch metrics are taken on the un-normalized part pixels, so only those are converted to Lab
+    with stage('lab'):
+        part_pixels, part_sizes = gather_part_pixels(img, part_masks)
+        interior = gather_part_interiors(part_masks)
+        L, a, b = convert_to_lab(part_pixels, mode=mode)
+    #lab_parts = lab_normalize_from_bg(L, a, b, bg_mask, part_masks) -- removed as it increases error
+    with stage('metrics'):
+        metrics = compute_metrics_batched(L, a, b, part_sizes, bg_L=bg_L, interior=interior)
+    return part_masks, regions_sorted, metrics, drift
+
+def analyze_image_metrics(image_input, mode='float64', downscale=1, image=None):
+    """
+    Metrics-only entry point: the metrics of analyze_image_core_batch as plain arrays. Importing analysis_core and
+    calling this loads neither pandas nor matplotlib, the cold start is kept within benchmark.IMPORT_BUDGET_S
+    mode (str): color pipeline mode, 'float64' (reference), 'float32' or 'lut' (see PIPELINE_MODES in utils)
+    downscale (int): downscale factor for the coarse segmentation pass, 1 segments at full resolution
+    image (numpy Array): image_input already decoded, ex. by a read-ahead stage
+    OUTPUTS:
+    metrics (dict): the columns of build_results_table ('Part #', 'Blackness', 'Color Shift', 'Gloss Factor',
+                    'Median a*', 'Median b*', 'Red Rust Fraction', 'White Rust Fraction') as numpy arrays,
+                    one value per part from left to right
+    """
+    with stage('load'):
+        img = load_image(image if image is not None else image_input, mode=mode)
+    _, _, (blackness, color_shift, a_shift, b_shift, gloss, red_rust, white_rust), _ = _measure_parts(img, mode, downscale)
+    return {
+        'Part #': np.arange(1, len(blackness) + 1),
+        'Blackness': np.asarray(blackness),
+        'Color Shift': np.asarray(color_shift),
+        'Gloss Factor': np.asarray(gloss),
+        'Median a*': np.asarray(a_shift),
+        'Median b*': np.asarray(b_shift),
+        'Red Rust Fraction': np.asarray(red_rust),
+        'White Rust Fraction': np.asarray(white_rust),
+    }
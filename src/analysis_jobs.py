@@ -0,0 +1,98 @@
+"""
+Background analysis jobs for interactive front ends (streamlit_app).
+
+Uploads are analyzed in a small thread pool, so the front end stays responsive and can show the stage each
+analysis is in. Finished results are kept in a bounded cache keyed on the uploaded bytes (and the options),
+so rerunning the front end script (ex. on a download click) never analyzes the same upload twice.
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from analysis_core import analyze_image_core
+from instrumentation import report_progress
+from visualization import PREVIEW_SIZE
+
+MAX_RESULTS = 16  # finished analyses kept, the least recently used are dropped past this
+MAX_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+
+# the stages of analyze_image_core in the order they run, to turn the current stage into a progress fraction
+STAGES = ('cache', 'load', 'threshold', 'regions', 'masks', 'background', 'normalize', 'lab', 'metrics', 'table', 'figures')
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='analysis')
+_jobs = OrderedDict()
+_lock = threading.Lock()
+
+def _job_key(data, options):
+    h = hashlib.sha256(data)
+    h.update(repr(sorted(options.items())).encode())
+    return h.hexdigest()
+
+def _run(job, data, options):
+    """
+    Analyzes one upload in a worker thread and returns what the front end shows, as bytes that are cheap to keep
+    """
+    def on_stage(name):
+        job['stage'] = name
+
+    with report_progress(on_stage):
+        df, fig, annotated_buf = analyze_image_core(io.BytesIO(data), return_fig=True, preview=PREVIEW_SIZE, **options)
+    job['stage'] = 'done'
+    figure_png = io.BytesIO()
+    # the figure is on its own Agg canvas, not pyplot's, so it is freed with the result and nothing is closed
+    fig.savefig(figure_png, format='png', dpi=72)
+    return {'df': df, 'figure_png': figure_png.getvalue(), 'annotated_jpg': annotated_buf.getvalue()}
+
+def submit_analysis(data, name, **options):
+    """
+    Starts analyzing an upload in the background, unless the same bytes were already submitted
+    INPUTS:
+    data (bytes): the content of the uploaded image
+    name (str): the name of the upload, for display
+    options: options passed on to analyze_image_core (ex. mode or downscale)
+    OUTPUTS:
+    key (str): the key to get the status and result of the analysis with
+    """
+    key = _job_key(data, options)
+    with _lock:
+        if key in _jobs:
+            _jobs.move_to_end(key)
+            return key
+        job = {'name': name, 'stage': 'queued'}
+        job['future'] = _executor.submit(_run, job, data, options)
+        _jobs[key] = job
+
+        # drop the least recently used finished analyses, a running one is never dropped
+        finished = [k for k, j in _jobs.items() if j['future'].done()]
+        for k in finished[:max(0, len(_jobs) - MAX_RESULTS)]:
+            del _jobs[k]
+    return key
+
+def job_status(key):
+    """
+    Reports how far an analysis is
+    INPUTS:
+    key (str): the key from submit_analysis
+    OUTPUTS:
+    status (dict or None): 'name', 'stage', 'progress' (0 to 1), 'done', 'error' (message or None) and 'result'
+                           (dict with df, figure_png and annotated_jpg once done), None if the key is not known (anymore)
+    """
+    with _lock:
+        job = _jobs.get(key)
+    if job is None:
+        return None
+    future = job['future']
+    status = {'name': job['name'], 'stage': job['stage'], 'done': future.done(), 'error': None, 'result': None}
+    if job['stage'] in STAGES:
+        status['progress'] = STAGES.index(job['stage']) / len(STAGES)
+    else:
+        status['progress'] = 1.0 if future.done() else 0.0
+    if future.done():
+        error = future.exception()
+        if error is not None:
+            status['error'] = f'{type(error).__name__}: {error}'
+        else:
+            status['result'] = future.result()
+    return status
@@ -0,0 +1,283 @@
+"""
+Local HTTP analysis service with a warm worker pool.
+
+Keeps the analysis imported and warmed up in a pool of worker processes, so a capture station pays no Python
+startup or import cost per photo:
+
+    python analysis_service.py --workers 2 --cache-dir cache
+
+    curl --data-binary @photo.jpg "http://127.0.0.1:8765/analyze?name=photo.jpg"
+    curl -d '{"paths": ["/data/photo1.jpg", "/data/photo2.jpg"]}' -H 'Content-Type: application/json' http://127.0.0.1:8765/analyze
+    curl http://127.0.0.1:8765/stats
+
+POST /analyze takes the image bytes as the body, or JSON with a "path" or a list of "paths", and returns the
+metrics of each image as JSON. Requests that arrive while the workers are busy are sent to a worker together,
+one batch per worker. GET /stats reports the queue depth, the requests in flight and latency percentiles.
+The service listens on 127.0.0.1 only by default, since it reads any path it is given.
+"""
+import argparse
+import collections
+import io
+import json
+import math
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from analysis_core import analyze_image_core_batch
+from result_cache import CACHE_STATS, DEFAULT_MAX_BYTES
+
+DEFAULT_PORT = 8765
+MAX_BATCH = 4             # most images sent to one worker at a time, a batch is answered when its last image is done
+LATENCY_WINDOW = 1000     # latencies of the most recent requests the percentiles are taken over
+REQUEST_TIMEOUT = 300     # seconds a request waits for its result
+WARMUP_TIMEOUT = 300      # seconds the service waits for every worker to warm up
+
+def _warm_worker(ready=None):
+    """
+    Runs once in each worker process: analyzes a small synthetic image so every lazy import and
+    first-call setup happens before the first real request
+    INPUTS:
+    ready (Barrier): barrier of all the workers and the service, passed once warm, None to not wait for the others
+    """
+    try:
+        from PIL import Image
+        from synthetic_images import make_lightbox_image
+        buffer = io.BytesIO()
+        Image.fromarray(make_lightbox_image(0.3, n_parts=2)).save(buffer, format='PNG')
+        buffer.seek(0)
+        analyze_image_core_batch(buffer)
+    except BaseException:
+        # the service and the other workers stop waiting instead of running into the timeout
+        if ready is not None:
+            ready.abort()
+        raise
+    if ready is not None:
+        # a warm worker takes no task before all are warm, so the pool starts a new process for every warm-up task
+        ready.wait(timeout=WARMUP_TIMEOUT)
+
+def _analyze_items(items, options):
+    """
+    Worker task: analyzes a batch of images, errors are returned per image so one bad image does not fail the batch
+    INPUTS:
+    items (list): (name, image bytes or None, path or None) of each image
+    options (dict): options passed on to analyze_image_core_batch
+    OUTPUTS:
+    results (list): for each image its name, the metrics of each part (or None), the error (or None) and whether
+                    the metrics came from the result cache
+    """
+    results = []
+    for name, data, path in items:
+        hits = CACHE_STATS['hits']
+        try:
+            df = analyze_image_core_batch(io.BytesIO(data) if data is not None else path, **options)
+            # NaN is not valid JSON
+            parts = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+            results.append({'name': name, 'parts': parts, 'error': None, 'cached': CACHE_STATS['hits'] > hits})
+        except Exception as e:
+            results.append({'name': name, 'parts': None, 'error': f'{type(e).__name__}: {e}', 'cached': False})
+    return results
+
+class AnalysisService:
+    """
+    The warm pool and the dispatcher that coalesces waiting requests into one batch per free worker
+    """
+    def __init__(self, workers=1, **options):
+        self.workers = workers
+        self.options = options
+        context = multiprocessing.get_context()
+        self.ready = context.Barrier(workers + 1)
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                            initializer=_warm_worker, initargs=(self.ready,))
+        self.pending = queue.Queue()
+        self.free = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started = time.time()
+        self.dispatcher = threading.Thread(target=self._dispatch, name='dispatcher', daemon=True)
+
+    def start(self):
+        """
+        Starts every worker process and waits until they are warm, then starts dispatching
+        """
+        # one task per worker makes the pool start all of its processes now instead of on demand
+        warmups = [self.executor.submit(int) for _ in range(self.workers)]
+        try:
+            # every worker passes the barrier at the end of its warm-up
+            self.ready.wait(timeout=WARMUP_TIMEOUT)
+        except threading.BrokenBarrierError:
+            raise RuntimeError(f'A worker failed to warm up, or not within {WARMUP_TIMEOUT} s') from None
+        for warmup in warmups:
+            warmup.result()
+        self.dispatcher.start()
+
+    def submit(self, name, data=None, path=None):
+        """
+        Queues one image for analysis
+        INPUTS:
+        name (str): name of the image, returned with its result
+        data (bytes): the image file content, or None to read path
+        path (str): path of the image file on this machine
+        OUTPUTS:
+        future (Future): resolves to the result dict of the image
+        """
+        future = Future()
+        self.pending.put(((name, data, path), future, time.perf_counter()))
+        return future
+
+    def _dispatch(self):
+        while True:
+            self.free.acquire()
+            batch = [self.pending.get()]
+            # split what is waiting over the free workers, so an idle pool is not handed one big batch
+            with self.lock:
+                free_workers = self.workers - self.in_flight
+            size = min(MAX_BATCH, max(1, math.ceil((self.pending.qsize() + 1) / max(1, free_workers))))
+            while len(batch) < size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.in_flight += 1
+                self.batches += 1
+            task = self.executor.submit(_analyze_items, [item for item, _, _ in batch], self.options)
+            task.add_done_callback(lambda task, batch=batch: self._finish(task, batch))
+
+    def _finish(self, task, batch):
+        try:
+            results = task.result()
+        except Exception as e:
+            # the worker process died (ex. out of memory), every image of the batch fails
+            results = [{'name': name, 'parts': None, 'error': f'{type(e).__name__}: {e}', 'cached': False}
+                       for (name, _, _), _, _ in batch]
+        now = time.perf_counter()
+        with self.lock:
+            self.in_flight -= 1
+            for (_, future, queued), result in zip(batch, results):
+                result['latency_ms'] = (now - queued) * 1000
+                self.latencies.append(result['latency_ms'])
+                self.completed += 1
+                self.failed += result['error'] is not None
+        self.free.release()
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        """
+        Reports the load and latency of the service
+        OUTPUTS:
+        stats (dict): queue depth, batches in flight, request counts, mean batch size and latency percentiles (ms)
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {
+                'workers': self.workers,
+                'queue_depth': self.pending.qsize(),
+                'batches_in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'mean_batch_size': self.completed / self.batches if self.batches else 0.0,
+                'uptime_s': time.time() - self.started,
+            }
+        for p in (50, 90, 99):
+            stats[f'latency_p{p}_ms'] = float(np.percentile(latencies, p)) if latencies else None
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+def _make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            route = urlparse(self.path).path
+            if route == '/stats':
+                self._reply(200, service.stats())
+            elif route == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': f'Unknown endpoint {route}'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/analyze':
+                self._reply(404, {'error': f'Unknown endpoint {url.path}'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            # a list of paths gets a list of results, a single path or upload a single result
+            many = False
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    request = json.loads(body)
+                    many = 'paths' in request
+                    paths = list(request['paths']) if many else [request['path']]
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400, {'error': 'Expected JSON with a "path" or a list of "paths"'})
+                    return
+                futures = [service.submit(str(path), path=str(path)) for path in paths]
+            else:
+                name = parse_qs(url.query).get('name', ['upload'])[0]
+                futures = [service.submit(name, data=body)]
+            try:
+                results = [f.result(timeout=REQUEST_TIMEOUT) for f in futures]
+            except TimeoutError:
+                self._reply(504, {'error': f'No result within {REQUEST_TIMEOUT} s'})
+                return
+            self._reply(200, results if many else results[0])
+
+        def log_message(self, format, *args):
+            # one line per request on stdout is too much for a capture station sending every photo
+            pass
+
+    return Handler
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve image analysis over HTTP from a warm worker pool.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes kept warm')
+    parser.add_argument('--mode', default='float64', help="color pipeline mode, 'float64', 'float32' or 'lut'")
+    parser.add_argument('--downscale', type=int, default=1, help='downscale factor of the coarse segmentation pass')
+    parser.add_argument('--cache-dir', help='result cache directory')
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_MAX_BYTES)
+    args = parser.parse_args(argv)
+
+    service = AnalysisService(
+        workers=args.workers,
+        mode=args.mode,
+        downscale=args.downscale,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_max_bytes
+    )
+    print(f'Starting {args.workers} worker(s)...')
+    service.start()
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(service))
+    print(f'Serving on http://{args.host}:{args.port} (Ctrl+C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping.')
+    finally:
+        server.server_close()
+        service.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Raster renderer of the numbered-parts image.
+
+The part numbers (and optionally the Blackness of each part and the part outlines) are drawn straight onto an
+8-bit copy of the image, downscaled first if asked, and encoded to JPEG or PNG with Pillow. No plotting backend
+is involved, so it is cheap enough to run for every image of a batch.
+"""
+import os
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from scipy.ndimage import binary_erosion
+from segmentation import iter_part_masks, part_centroids
+
+LABEL_COLOR = (255, 255, 0)    # yellow text on a black box, as in the figures
+OUTLINE_COLOR = (255, 255, 0)
+
+def _to_uint8(image, rows=256):
+    if image.dtype == np.uint8:
+        return image.copy()
+    # a band of rows at a time, so a float image is never copied whole
+    out = np.empty(image.shape, dtype=np.uint8)
+    for r in range(0, image.shape[0], rows):
+        out[r:r + rows] = np.clip(image[r:r + rows], 0, 1) * 255 + 0.5
+    return out
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except (TypeError, OSError):
+        # Pillow before 10.1 or without FreeType only has a small fixed-size bitmap font
+        return ImageFont.load_default()
+
+def render_numbered_parts(image, part_masks, centroids=None, blackness=None, outlines=False, max_size=None):
+    """
+    Draws the number of each part (and optionally its Blackness and outline) onto a copy of the image
+    INPUTS:
+    image (numpy Array): the image, float in [0, 1] or 8-bit
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    centroids (list): the (row, column) centroid of each part, found from part_masks if None
+    blackness (list): the Blackness of each part to write next to its number, None for the numbers only
+    outlines (bool): also draw the outline of each part
+    max_size (int): downscale the image to at most this many pixels on its longest side first, None for full resolution
+    OUTPUTS:
+    annotated (uint8 numpy Array): the annotated RGB image
+    """
+    if centroids is None:
+        centroids = part_centroids(part_masks)
+    step = 1 if max_size is None else max(1, int(np.ceil(max(image.shape[:2]) / max_size)))
+    annotated = _to_uint8(image[::step, ::step])
+
+    if outlines:
+        for slc, mask in iter_part_masks(part_masks):
+            # the outline of the part in the (downscaled) crop of its bounding box
+            r0 = -(-slc[0].start // step)
+            c0 = -(-slc[1].start // step)
+            small = mask[(r0 * step - slc[0].start)::step, (c0 * step - slc[1].start)::step]
+            edge = small & ~binary_erosion(small, border_value=0)
+            annotated[r0:r0 + small.shape[0], c0:c0 + small.shape[1]][edge] = OUTLINE_COLOR
+
+    canvas = Image.fromarray(annotated)
+    draw = ImageDraw.Draw(canvas)
+    font = _font(max(12, min(annotated.shape[:2]) // 30))
+    for i, (y, x) in enumerate(centroids):
+        text = f'{i+1}' if blackness is None else f'{i+1}: {blackness[i]:.2f}'
+        left, top, right, bottom = draw.textbbox((x / step, y / step), text, font=font, anchor='mm')
+        pad = max(2, (bottom - top) // 5)
+        draw.rectangle((left - pad, top - pad, right + pad, bottom + pad), fill=(0, 0, 0))
+        draw.text((x / step, y / step), text, fill=LABEL_COLOR, font=font, anchor='mm')
+    return np.asarray(canvas)
+
+def encode_image(annotated, file_or_buffer, format=None, quality=90):
+    """
+    Encodes an annotated image to JPEG or PNG
+    INPUTS:
+    annotated (uint8 numpy Array): the image from render_numbered_parts
+    file_or_buffer (str or file-like): where to write the image
+    format (str): 'jpeg' or 'png', taken from the file extension if None (JPEG for buffers)
+    quality (int): JPEG quality
+    """
+    if format is None:
+        is_png = isinstance(file_or_buffer, str) and os.path.splitext(file_or_buffer)[1].lower() == '.png'
+        format = 'png' if is_png else 'jpeg'
+    options = {'quality': quality} if format.lower() in ('jpeg', 'jpg') else {}
+    Image.fromarray(annotated).save(file_or_buffer, format='PNG' if format.lower() == 'png' else 'JPEG', **options)
+
+def save_numbered_parts_with_metrics(substrate, part_masks, blackness, file_or_buffer, centroids=None, preview=None,
+                                     show_blackness=False, outlines=False):
+    """
+    Saves the image with the number of each part drawn on it, as a JPEG (or a PNG for a .png path)
+    INPUTS:
+    substrate (numpy Array): the image, float in [0, 1] or 8-bit
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    blackness (list): the Blackness of each part
+    file_or_buffer (str or file-like): where to save the image
+    centroids (list): the (row, column) centroid of each part, found from part_masks if None
+    preview (int): save the image at most this many pixels on its longest side, None for full resolution
+    show_blackness (bool): write the Blackness of each part next to its number
+    outlines (bool): also draw the outline of each part
+    """
+    annotated = render_numbered_parts(substrate, part_masks, centroids=centroids,
+                                      blackness=blackness if show_blackness else None,
+                                      outlines=outlines, max_size=preview)
+    encode_image(annotated, file_or_buffer)
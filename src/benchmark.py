@@ -0,0 +1,292 @@
+"""
+Benchmark suite for the analysis pipeline on synthetic lightbox images.
+
+Times every public pipeline function and both analyze_image_core entry points, records
+throughput and peak memory, and fails when a case is slower or uses more memory than a
+stored baseline by more than a threshold.
+
+    python benchmark.py --save-baseline            # record a baseline on this machine
+    python benchmark.py                            # compare against it, exit code 1 on regression
+    python benchmark.py --resolutions 2 12 24 45   # full resolution sweep
+
+It also measures the cold start of the metrics-only path (import analysis_core and one analyze_image_metrics call in
+a fresh interpreter) and fails when it takes longer than IMPORT_BUDGET_S or loads pandas or matplotlib.
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from PIL import Image
+
+from synthetic_images import make_lightbox_image
+from utils import load_image, build_results_table
+from segmentation import (
+    threshold_parts,
+    extract_part_regions,
+    sort_regions_l2r,
+    regions_to_masks,
+    compute_background,
+    HOLE_AREA
+)
+from binary_morphology import dilate_disk, close_disk, fill_holes
+from color_processing import (
+    linear_normalize_from_bg,
+    convert_to_lab,
+    gather_part_pixels,
+    split_lab_parts,
+    get_lab_parts,
+    compute_metrics,
+    compute_metrics_batched
+)
+from visualization import show_results, save_numbered_parts_with_metrics, PREVIEW_SIZE
+from analysis_core import analyze_image_core, analyze_image_core_batch, analyze_image_metrics, MIN_AREA
+from tiled_analysis import analyze_image_tiled
+
+# machine specific results, kept out of the source tree (benchmark_results/ is ignored by git)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark_results',
+                                'baseline.json')
+DEFAULT_RESOLUTIONS = (2, 12)
+DEFAULT_THRESHOLD = 0.25
+MIN_COMPARED_TIME = 0.005  # cases faster than this are too noisy to flag as regressions
+IMPORT_BUDGET_S = 0.8      # cold start budget of the metrics-only path, 0.51 s measured on a 1 CPU reference machine
+METRICS_ONLY_EXCLUDED = ('pandas', 'matplotlib', 'skimage.io', 'visualization', 'annotation', 'tiled_analysis')
+
+# run in a fresh interpreter, so nothing the benchmark itself imported is already loaded
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import analysis_core
+import_s = time.perf_counter() - start
+from synthetic_images import make_lightbox_image
+analysis_core.analyze_image_metrics(make_lightbox_image(0.3, n_parts=2))
+print(json.dumps({'import_s': import_s, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+def _measure(fn, repeats):
+    """
+    Times a function (best of repeats) and measures its peak allocated memory in one extra traced run
+    INPUTS:
+    fn (callable): the function to measure, called without arguments
+    repeats (int): number of timed runs
+    OUTPUTS:
+    time_s (float): best wall time in seconds
+    peak_mb (float): peak memory allocated during the call in MB
+    result: the return value of the last call
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+        plt.close('all')
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        plt.close('all')
+    return best, peak / 1024**2, result
+
+def benchmark_resolution(megapixels, n_parts=10, repeats=3, seed=0, workdir=None):
+    """
+    Benchmarks every stage of the pipeline on one synthetic image
+    INPUTS:
+    megapixels (float): size of the synthetic image
+    n_parts (int): number of parts in the synthetic image
+    repeats (int): number of timed runs per case
+    seed (int): seed of the synthetic image
+    workdir (str): directory to write the synthetic JPEG to
+    OUTPUTS:
+    results (dict): '<MP>MP/<function>' -> time_s, peak_mb, mpix_per_s (and images_per_s for the entry points)
+    """
+    workdir = workdir or tempfile.gettempdir()
+    path = os.path.join(workdir, f'benchmark_{megapixels}mp_{n_parts}parts_{seed}.jpg')
+    image = make_lightbox_image(megapixels, n_parts, seed=seed)
+    Image.fromarray(image).save(path, quality=92)
+    mpix = image.shape[0] * image.shape[1] / 1e6
+    del image
+
+    results = {}
+
+    def run(name, fn, entry_point=False):
+        t, peak, result = _measure(fn, repeats)
+        results[f'{megapixels}MP/{name}'] = {
+            'time_s': t,
+            'peak_mb': peak,
+            'mpix_per_s': mpix / t if t > 0 else 0.0,
+        }
+        if entry_point:
+            results[f'{megapixels}MP/{name}']['images_per_s'] = 1 / t if t > 0 else 0.0
+        print(f'{megapixels:>4}MP  {name:<34} {t:8.3f} s  {peak:9.1f} MB')
+        return result
+
+    img = run('load_image', lambda: load_image(path))
+    gray, binary, thresh = run('threshold_parts', lambda: threshold_parts(img))
+    run('threshold_parts(downscale=4)', lambda: threshold_parts(img, downscale=4, min_area=MIN_AREA))
+    coarse_mask = gray < thresh
+    run('dilate_disk(6)', lambda: dilate_disk(coarse_mask, 6))
+    run('close_disk(4)', lambda: close_disk(coarse_mask, 4))
+    run('fill_holes', lambda: fill_holes(coarse_mask, max_border_hole=HOLE_AREA))
+    del coarse_mask
+    labels, regions = run('extract_part_regions', lambda: extract_part_regions(binary, min_area=MIN_AREA))
+    regions_sorted = run('sort_regions_l2r', lambda: sort_regions_l2r(regions))
+    part_masks = run('regions_to_masks', lambda: regions_to_masks(labels, regions_sorted))
+    bg_mask = run('compute_background', lambda: compute_background(gray, part_masks))
+    run('compute_background(max_error=0.5)', lambda: compute_background(gray, part_masks, max_error=0.5))
+    norm_img = run('linear_normalize_from_bg', lambda: linear_normalize_from_bg(img, bg_mask))
+    L, a, b = run('convert_to_lab', lambda: convert_to_lab(norm_img))
+    del norm_img
+    run('get_lab_parts', lambda: get_lab_parts(L, a, b, part_masks))
+    del L, a, b
+    part_pixels, part_sizes = run('gather_part_pixels', lambda: gather_part_pixels(img, part_masks))
+    norm_pixels = run('linear_normalize_from_bg(pixels)',
+                      lambda: linear_normalize_from_bg(img, bg_mask, pixels=part_pixels))
+    Lp, ap, bp = run('convert_to_lab(pixels)', lambda: convert_to_lab(norm_pixels))
+    lab_parts = run('split_lab_parts', lambda: split_lab_parts(Lp, ap, bp, part_sizes))
+    run('compute_metrics', lambda: compute_metrics(lab_parts))
+    metrics = run('compute_metrics_batched', lambda: compute_metrics_batched(Lp, ap, bp, part_sizes))
+    run('build_results_table', lambda: build_results_table(*metrics))
+    run('show_results', lambda: show_results(img, gray, thresh, binary, part_masks, bg_mask, return_fig=True))
+    run('save_numbered_parts_with_metrics',
+        lambda: save_numbered_parts_with_metrics(img, part_masks, metrics[0], os.path.join(workdir, 'benchmark_numbered.jpg')))
+    del img, gray, binary, labels, regions, regions_sorted, part_masks, bg_mask, part_pixels, norm_pixels
+
+    run('analyze_image_core', lambda: analyze_image_core(path, return_fig=True), entry_point=True)
+    run('analyze_image_core(preview)', lambda: analyze_image_core(path, return_fig=True, preview=PREVIEW_SIZE),
+        entry_point=True)
+    run('analyze_image_core(no figures)', lambda: analyze_image_core(path, return_fig=False, annotate=False),
+        entry_point=True)
+    df = run('analyze_image_core_batch', lambda: analyze_image_core_batch(path), entry_point=True)
+    run('analyze_image_metrics', lambda: analyze_image_metrics(path), entry_point=True)
+    run('analyze_image_core_batch(ds=4)', lambda: analyze_image_core_batch(path, downscale=4), entry_point=True)
+    run('analyze_image_tiled(raw, 64 MB)',
+        lambda: analyze_image_tiled(path, normalized=False, downscale=4, min_area=MIN_AREA, memory_budget=64 * 1024**2),
+        entry_point=True)
+    if len(df) != n_parts:
+        print(f'WARNING: {len(df)} parts found in the {megapixels}MP image, expected {n_parts}')
+    os.remove(path)
+    return results
+
+def benchmark_imports(repeats=5):
+    """
+    Measures the cold start of the metrics-only path: importing analysis_core in a fresh interpreter
+    INPUTS:
+    repeats (int): number of interpreters started, the best time is kept
+    OUTPUTS:
+    results (dict): 'import/analysis_core' -> time_s and the modules of METRICS_ONLY_EXCLUDED that were loaded
+                    by the import or by a first analyze_image_metrics call
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    script = _IMPORT_SCRIPT % (METRICS_ONLY_EXCLUDED,)
+    best, loaded = float('inf'), []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-W', 'ignore', '-c', script], cwd=src_dir, capture_output=True,
+                             text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        best, loaded = min(best, result['import_s']), result['loaded']
+    print(f'{"":>6}  {"import analysis_core":<34} {best:8.3f} s')
+    return {'import/analysis_core': {'time_s': best, 'peak_mb': 0.0, 'loaded': loaded}}
+
+def check_import_budget(results, budget=IMPORT_BUDGET_S):
+    """
+    Checks the metrics-only cold start against its budget
+    INPUTS:
+    results (dict): results from benchmark_imports
+    budget (float): the budget in seconds
+    OUTPUTS:
+    violations (list): a description of each violation
+    """
+    result = results['import/analysis_core']
+    violations = []
+    if result['time_s'] > budget:
+        violations.append(f"import analysis_core: {result['time_s']:.3f} s vs budget {budget:.3f} s")
+    if result['loaded']:
+        violations.append(f"import analysis_core: the metrics-only path loaded {', '.join(result['loaded'])}")
+    return violations
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Finds the cases that got slower or use more memory than the baseline by more than threshold
+    INPUTS:
+    results (dict): results from benchmark_resolution
+    baseline (dict): stored results to compare against
+    threshold (float): allowed relative increase, 0.25 allows 25% slower
+    OUTPUTS:
+    regressions (list): a description of each regression
+    """
+    regressions = []
+    for case, result in results.items():
+        ref = baseline.get(case)
+        if ref is None:
+            continue
+        if ref['time_s'] >= MIN_COMPARED_TIME and result['time_s'] > ref['time_s'] * (1 + threshold):
+            regressions.append(f"{case}: {result['time_s']:.3f} s vs baseline {ref['time_s']:.3f} s")
+        if ref['peak_mb'] >= 1 and result['peak_mb'] > ref['peak_mb'] * (1 + threshold):
+            regressions.append(f"{case}: {result['peak_mb']:.1f} MB vs baseline {ref['peak_mb']:.1f} MB")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the color analysis pipeline on synthetic images.')
+    parser.add_argument('--resolutions', type=float, nargs='+', default=list(DEFAULT_RESOLUTIONS),
+                        help='image sizes in megapixels (2 to 45)')
+    parser.add_argument('--parts', type=int, default=10, help='parts per synthetic image')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per case, the best is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed relative slowdown or memory growth before failing')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_S,
+                        help='cold start budget in seconds of the metrics-only path')
+    args = parser.parse_args(argv)
+
+    results = benchmark_imports()
+    violations = check_import_budget(results, args.import_budget)
+    with tempfile.TemporaryDirectory() as workdir:
+        for mp in args.resolutions:
+            mp = int(mp) if float(mp).is_integer() else mp
+            results.update(benchmark_resolution(mp, args.parts, args.repeats, args.seed, workdir))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    for v in violations:
+        print('Over budget: ' + v)
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline first')
+        return 1 if violations else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s) beyond {args.threshold:.0%}:')
+        for r in regressions:
+            print('  ' + r)
+        return 1
+    print(f'No regressions beyond {args.threshold:.0%} against {args.baseline}')
+    return 1 if violations else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Morphology on boolean images for the segmentation stage.
+
+The generic grey-level operators treat a mask as an image and visit every footprint pixel for every image pixel.
+Here a disk is split into its rows instead: the mask is first dilated horizontally, once per distinct row half-width
+(growing one pixel at a time in a single buffer), and every row of the disk then ORs that buffer into the output
+shifted by its row offset. A disk of radius r takes about 2r + (2r + 1) whole-array ORs. Erosion is the complement of
+the dilation of the complement, and hole filling is one connected component labelling of the background.
+
+The results are identical to skimage.morphology.dilation / binary_closing with skimage.morphology.disk and to
+scipy.ndimage.binary_fill_holes followed by skimage.morphology.remove_small_holes.
+"""
+import numpy as np
+from scipy import ndimage as ndi
+
+def disk_half_widths(radius):
+    """
+    Half-width of each row of the disk footprint of skimage.morphology.disk: the pixels with x² + y² <= radius²
+    INPUTS:
+    radius (int): radius of the disk
+    OUTPUTS:
+    half_widths (list): (row offset, half-width) of every row of the disk, top to bottom
+    """
+    half_widths = []
+    for dy in range(-radius, radius + 1):
+        w = int(np.sqrt(radius * radius - dy * dy))
+        # the float square root of a perfect square can land just below it
+        while (w + 1) ** 2 <= radius * radius - dy * dy:
+            w += 1
+        half_widths.append((dy, w))
+    return half_widths
+
+def dilate_disk(mask, radius, out=None):
+    """
+    Dilates a boolean image with a disk, the pixels outside the image are False
+    INPUTS:
+    mask (bool numpy Array): the 2D image to dilate
+    radius (int): radius of the disk
+    out (bool numpy Array): array of the same shape to write the result to, it may not be mask
+    OUTPUTS:
+    dilated (bool numpy Array): the dilated image (out if given)
+    """
+    if out is None:
+        out = np.zeros_like(mask, dtype=bool)
+    else:
+        out[...] = False
+    rows = disk_half_widths(radius)
+    grown = mask.astype(bool, copy=True)
+    for w in range(radius + 1):
+        if w:
+            # one pixel wider on each side: shift right, then the right-grown rows left
+            grown[:, 1:] |= grown[:, :-1]
+            grown[:, :-1] |= grown[:, 1:]
+        for dy, half_width in rows:
+            if half_width != w:
+                continue
+            if dy == 0:
+                out |= grown
+            elif dy > 0:
+                out[dy:] |= grown[:-dy]
+            else:
+                out[:dy] |= grown[-dy:]
+    return out
+
+def erode_disk(mask, radius, out=None):
+    """
+    Erodes a boolean image with a disk, the pixels outside the image are True so the border does not erode the mask
+    INPUTS:
+    mask (bool numpy Array): the 2D image to erode
+    radius (int): radius of the disk
+    out (bool numpy Array): array of the same shape to write the result to, it may not be mask
+    OUTPUTS:
+    eroded (bool numpy Array): the eroded image (out if given)
+    """
+    out = dilate_disk(~mask, radius, out=out)
+    np.logical_not(out, out=out)
+    return out
+
+def close_disk(mask, radius, out=None):
+    """
+    Closes a boolean image with a disk: a dilation followed by an erosion
+    INPUTS:
+    mask (bool numpy Array): the 2D image to close
+    radius (int): radius of the disk
+    out (bool numpy Array): array of the same shape to write the result to, it may not be mask
+    OUTPUTS:
+    closed (bool numpy Array): the closed image (out if given)
+    """
+    dilated = dilate_disk(mask, radius)
+    # the complement of the dilation is dilated in place of a second temporary
+    np.logical_not(dilated, out=dilated)
+    out = dilate_disk(dilated, radius, out=out)
+    np.logical_not(out, out=out)
+    return out
+
+def fill_holes(mask, max_border_hole=0):
+    """
+    Fills the holes of a boolean image: the background regions (4-connected) that do not touch the border of the
+    image, and the ones that do but have at most max_border_hole pixels. Identical to binary_fill_holes followed by
+    remove_small_holes(area_threshold=max_border_hole), in one labelling of the background.
+    INPUTS:
+    mask (bool numpy Array): the 2D image
+    max_border_hole (int): largest background region touching the border that is filled too, 0 for none
+    OUTPUTS:
+    filled (bool numpy Array): the filled image
+    """
+    labels, n = ndi.label(~mask)
+    fill = np.ones(n + 1, dtype=bool)
+    fill[0] = False
+    border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+    fill[border] = False
+    if max_border_hole > 0:
+        fill |= np.bincount(labels.ravel(), minlength=n + 1) <= max_border_hole
+        fill[0] = False
+    return mask | fill[labels]
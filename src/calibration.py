@@ -0,0 +1,177 @@
+"""
+Lightbox calibration profiles.
+
+The lightbox, lighting and camera settings stay fixed for a session, so the background correction can be
+found once from reference frames and reused for every image of the session:
+
+    python calibration.py ref1.jpg ref2.jpg -o session.npz
+
+A profile holds the per-channel correction (the mean linear RGB background color) and the background
+region common to all reference frames. It is either applied directly, replacing the per-image background
+step, or only used to verify that the background of each frame has not drifted from it.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import numpy as np
+from utils import load_image, srgb_to_linear, SRGB_TO_LINEAR_LUT
+from segmentation import (
+    threshold_parts,
+    extract_part_regions,
+    sort_regions_l2r,
+    regions_to_masks,
+    compute_background
+)
+
+CALIBRATION_USES = ('apply', 'verify')
+DRIFT_TOLERANCE = 0.03  # largest relative change of a channel's mean background before a frame is flagged
+DRIFT_SAMPLE_STEP = 4   # the drift is measured on every DRIFT_SAMPLE_STEP-th pixel in both directions
+
+def build_calibration(image_inputs, downscale=1, min_area=3000, drift_tolerance=DRIFT_TOLERANCE):
+    """
+    Builds a calibration profile from reference frames of the empty or loaded lightbox
+    INPUTS:
+    image_inputs (list): file paths (or open files) of the reference frames, all the same size
+    downscale (int): downscale factor for the coarse segmentation pass of the reference frames
+    min_area (int): the minimum area of a part in the reference frames
+    drift_tolerance (float): relative change of the mean background above which a frame is flagged as drifted
+    OUTPUTS:
+    profile (dict): 'bg_mean' the mean linear RGB background color, 'correction' its inverse,
+                    'bg_mask' the background region of every reference frame, 'spread' the largest relative
+                    difference of a reference frame's background from bg_mean, 'drift_tolerance', 'n_frames' and 'id'
+    """
+    if not image_inputs:
+        raise ValueError('At least one reference frame is needed to build a calibration profile')
+    bg_mask = None
+    frame_means = []
+    for image_input in image_inputs:
+        img = load_image(image_input)
+        gray, binary, _ = threshold_parts(img, downscale=downscale, min_area=min_area)
+        labels, regions = extract_part_regions(binary, min_area=min_area)
+        part_masks = regions_to_masks(labels, sort_regions_l2r(regions))
+        frame_mask = compute_background(gray, part_masks)
+        if bg_mask is not None and frame_mask.shape != bg_mask.shape:
+            raise ValueError(f'Reference frames differ in size: {frame_mask.shape} and {bg_mask.shape}')
+        frame_means.append(srgb_to_linear(img[frame_mask]).mean(axis=0))
+        # only keep the region that is background in every reference frame
+        bg_mask = frame_mask if bg_mask is None else bg_mask & frame_mask
+        del img, gray, binary, labels, regions, part_masks
+
+    frame_means = np.array(frame_means)
+    bg_mean = frame_means.mean(axis=0)
+    profile = {
+        'bg_mean': bg_mean,
+        'correction': 1.0 / bg_mean,
+        'bg_mask': bg_mask,
+        'spread': float(np.abs(frame_means / bg_mean - 1).max()),
+        'drift_tolerance': float(drift_tolerance),
+        'n_frames': len(frame_means),
+    }
+    profile['id'] = _profile_id(profile)
+    return profile
+
+def _profile_id(profile):
+    # identifies the profile in result cache keys, so results of a different profile are never reused
+    h = hashlib.sha256(profile['bg_mean'].tobytes())
+    h.update(np.packbits(profile['bg_mask']).tobytes())
+    return h.hexdigest()[:16]
+
+def save_calibration(profile, path):
+    """
+    Saves a calibration profile to a .npz file
+    INPUTS:
+    profile (dict): the profile from build_calibration
+    path (str): file path of the profile
+    """
+    meta = {k: profile[k] for k in ('spread', 'drift_tolerance', 'n_frames', 'id')}
+    with open(path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            bg_mean=profile['bg_mean'],
+            bg_mask=np.packbits(profile['bg_mask']),
+            shape=np.array(profile['bg_mask'].shape),
+            meta=json.dumps(meta)
+        )
+
+def load_calibration(path):
+    """
+    Loads a calibration profile saved with save_calibration
+    INPUTS:
+    path (str): file path of the profile
+    OUTPUTS:
+    profile (dict): the profile, as returned by build_calibration
+    """
+    with np.load(path) as data:
+        shape = tuple(data['shape'])
+        bg_mask = np.unpackbits(data['bg_mask'], count=int(np.prod(shape))).astype(bool).reshape(shape)
+        profile = json.loads(str(data['meta']))
+        profile['bg_mean'] = data['bg_mean']
+    profile['correction'] = 1.0 / profile['bg_mean']
+    profile['bg_mask'] = bg_mask
+    return profile
+
+def _check_shape(profile, shape):
+    if profile['bg_mask'].shape != shape:
+        raise ValueError(f"The image is {shape[1]}x{shape[0]} pixels but the calibration profile is "
+                         f"{profile['bg_mask'].shape[1]}x{profile['bg_mask'].shape[0]}, it was made for a different camera setup")
+
+def profile_bg_mask(profile, part_masks):
+    """
+    The background region of a profile without the parts of the current frame, so the profile
+    can be made from frames of the empty lightbox
+    INPUTS:
+    profile (dict): the calibration profile
+    part_masks (PartLabels): the part label image and the bounding box slice of each part of the frame
+    OUTPUTS:
+    bg_mask (bool numpy Array): the background mask of the frame
+    """
+    _check_shape(profile, part_masks.labels.shape)
+    bg_mask = profile['bg_mask'].copy()
+    for slc in part_masks.slices:
+        bg_mask[slc] &= part_masks.labels[slc] == 0
+    return bg_mask
+
+def background_drift(image, profile, part_masks, sample_step=DRIFT_SAMPLE_STEP):
+    """
+    Measures how far the background of a frame is from the calibration profile
+    INPUTS:
+    image (numpy Array): the frame, float in [0, 1] or 8-bit
+    profile (dict): the calibration profile
+    part_masks (PartLabels): the part label image and the bounding box slice of each part of the frame
+    sample_step (int): measure on every sample_step-th pixel in both directions
+    OUTPUTS:
+    drift (float): the largest relative difference of a channel's mean background from the profile
+    """
+    _check_shape(profile, part_masks.labels.shape)
+    grid = (slice(None, None, sample_step), slice(None, None, sample_step))
+    mask = profile['bg_mask'][grid] & (part_masks.labels[grid] == 0)
+    pixels = image[grid][mask]
+    if len(pixels) == 0:
+        return float('inf')
+    if pixels.dtype == np.uint8:
+        frame_mean = SRGB_TO_LINEAR_LUT[pixels].mean(axis=0)
+    else:
+        frame_mean = srgb_to_linear(pixels).mean(axis=0)
+    return float(np.abs(frame_mean / profile['bg_mean'] - 1).max())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a lightbox calibration profile from reference frames.')
+    parser.add_argument('images', nargs='+', help='reference frames of the empty or loaded lightbox')
+    parser.add_argument('-o', '--output', required=True, help='profile file to write (.npz)')
+    parser.add_argument('--downscale', type=int, default=1, help='downscale factor of the coarse segmentation pass')
+    parser.add_argument('--drift-tolerance', type=float, default=DRIFT_TOLERANCE,
+                        help='relative background change above which a frame is flagged')
+    args = parser.parse_args(argv)
+
+    profile = build_calibration(args.images, downscale=args.downscale, drift_tolerance=args.drift_tolerance)
+    save_calibration(profile, args.output)
+    print(f"Calibration profile {profile['id']} from {profile['n_frames']} frame(s) saved to {args.output}")
+    print(f"Background (linear RGB): {np.round(profile['bg_mean'], 4).tolist()}, "
+          f"{profile['bg_mask'].mean():.0%} of the frame, reference frames within {profile['spread']:.2%}")
+    if profile['spread'] > profile['drift_tolerance']:
+        print('WARNING: the reference frames differ by more than the drift tolerance')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,175 @@
 import numpy as np
-from skimage.color import rgb2lab
-from utils import linear_to_srgb, srgb_to_linear
+from skimage.color import rgb2lab, xyz2lab
+from skimage.color.colorconv import xyz_from_rgb
+from utils import linear_to_srgb, srgb_to_linear, SRGB_TO_LINEAR_LUT
+from segmentation import iter_part_masks, part_interior, BG_PERCENTILE
 
-def linear_normalize_from_bg(image, bg_mask):
+HIGHLIGHT_PERCENTILE = 95  # L percentile above which part pixels are specular highlights
+BLACKNESS_PERCENTILE = 10  # L percentile of the diffuse part pixels reported as Blackness
+# Corrosion, classified on the diffuse part pixels (highlights are light and colorless like white rust):
+# red rust is orange-brown with both a* and b* well above a black part's, white rust is light with little color
+# but darker than the lightbox showing through holes in a part (L* near 100 on the normalized image).
+# Pixels on the outline of a part mix it with the background and read as white rust, so the corrosion fractions
+# leave out a band of RUST_EDGE_MARGIN pixels along the outline.
+# On an un-normalized image the L* range is scaled to the lightness of the image's background (background_lightness).
+RED_RUST_MIN_A = 8          # a* above which a diffuse pixel with b* above RED_RUST_MIN_B is red rust
+RED_RUST_MIN_B = 12         # b* above which a diffuse pixel with a* above RED_RUST_MIN_A is red rust
+WHITE_RUST_L = (75, 92)     # L* range of white rust on the normalized image, where the background is at L* 100
+WHITE_RUST_MAX_CHROMA = 8   # largest sqrt(a*² + b*²) of a white rust pixel
+RUST_EDGE_MARGIN = 2        # width in pixels of the band along a part's outline left out of the corrosion fractions
+BG_LEVEL_STEP = 8           # the background lightness of an un-normalized image is taken on every 8th pixel both ways
+
+# sRGB decoding of every 8-bit value as done inside skimage's rgb2lab (its threshold differs from srgb_to_linear)
+_codes = np.arange(256) / 255.0
+LAB_LINEAR_LUT = np.where(_codes > 0.04045, ((_codes + 0.055) / 1.055) ** 2.4, _codes / 12.92).astype(np.float32)
+del _codes
+
+def background_correction(image, bg_mask):
+    """
+    Finds the per-channel correction that maps the mean background color to white in linear RGB
+    INPUTS:
+    image (numpy Array): A numpy array representing the image, float in [0, 1] or 8-bit
+    bg_mask (bool NumPy Array): A numpy array containing bools that act as the mask for the background
+    OUTPUTS:
+    correction (numpy Array): the factor to multiply each linear RGB channel by
+    """
+    if image.dtype == np.uint8:
+        bg_mean = SRGB_TO_LINEAR_LUT[image[bg_mask]].mean(axis=0)
+    else:
+        bg_mean = srgb_to_linear(image[bg_mask]).mean(axis=0)
+    return 1.0 / bg_mean
+
+def linear_normalize_from_bg(image, bg_mask, pixels=None, mode='float64', correction=None):
     """
     Normalize an image by dividing all color parameters of pixels in the image by the mean value of the background
     INPUTS:
     image (numpy Array): A numpy array representing the image to be analyzed
     bg_mask (bool NumPy Array): A numpy array containing bools that act as the mask for the background
+    pixels (numpy Array): optional (N, 3) array of pixels gathered from the image to normalize instead of the whole image
+    mode (str): 'float64' (reference), 'float32', or 'lut' for an 8-bit image, where the correction is applied
+                through a 256 entry table per channel and the result is quantized back to 8 bits
+    correction (numpy Array): optional per-channel correction to apply instead of the one found from bg_mask,
+                              ex. the one of a calibration profile
     OUTPUTS:
-    image_normalized (numpy Array): A numpy array with all the pixels normalized to the background
+    image_normalized (numpy Array): A numpy array with all the pixels (or only the given pixels) normalized to the background
     """
-    image = srgb_to_linear(image)
-    bg_pixels = image[bg_mask]
-    bg_mean = bg_pixels.mean(axis=0)
-    correction = 1.0 / bg_mean
-    image_normalized = np.clip(image * correction[None, None, :], 0, 1)
+    if mode == 'float32':
+        image = image.astype(np.float32, copy=False)
+        if pixels is not None:
+            pixels = pixels.astype(np.float32, copy=False)
+    if pixels is None:
+        pixels = image
+    if correction is None:
+        correction = background_correction(image, bg_mask)
+
+    if mode == 'lut':
+        table = linear_to_srgb(np.clip(SRGB_TO_LINEAR_LUT[:, None] * correction, 0, 1))
+        table = np.round(table * 255).astype(np.uint8)
+        return np.stack([table[pixels[..., c], c] for c in range(3)], axis=-1)
+
+    image_normalized = np.clip(srgb_to_linear(pixels) * correction, 0, 1)
     image_normalized = linear_to_srgb(image_normalized)
     return(image_normalized)
 
-def convert_to_lab(image):
+def convert_to_lab(image, mode='float64'):
     """
     Takes in an image and returns it as the lab components L, a* and b* for each pixel in the image
     INPUTS:
     image (numpy Array): A numpy array representing the image to be analyzed
+    mode (str): 'float64' (reference), 'float32', or 'lut' for an 8-bit image, where the sRGB decoding is a table lookup
+                and the rest of the conversion is done in float32
     OUTPUTS:
     L (numpy Array): A numpy array consisting of the L value of each pixel
     a (numpy Array): A numpy array consisting of the a value of each pixel
     b (numpy Array): A numpy array consisting of the b value of each pixel
     """
-    lab = rgb2lab(image)
+    if mode == 'lut':
+        lab = xyz2lab(LAB_LINEAR_LUT[image] @ xyz_from_rgb.T.astype(np.float32))
+    elif mode == 'float32':
+        lab = rgb2lab(image.astype(np.float32, copy=False))
+    else:
+        lab = rgb2lab(image)
     return lab[..., 0], lab[..., 1], lab[..., 2]
 
+def sampled_background_mean(image, gray, part_mask):
+    """
+    Mean linear RGB color of the background of a sample of the pixels of an image (ex. every BG_LEVEL_STEP-th pixel
+    in both directions), with the background picked as compute_background does: the non-part pixels above the
+    BG_PERCENTILE gray level
+    INPUTS:
+    image (numpy Array): the sampled pixels, float in [0, 1] or 8-bit
+    gray (numpy Array): the grayscale values of the same pixels
+    part_mask (bool numpy Array): which of the pixels belong to a part
+    OUTPUTS:
+    bg_mean (numpy Array): the mean linear RGB color of the sampled background
+    """
+    outside = ~part_mask
+    bg_mask = outside & (gray > np.percentile(gray[outside], BG_PERCENTILE))
+    if image.dtype == np.uint8:
+        return SRGB_TO_LINEAR_LUT[image[bg_mask]].mean(axis=0)
+    return srgb_to_linear(image[bg_mask]).mean(axis=0)
+
+def background_lightness(bg_mean):
+    """
+    L* of the mean background color, the level the white rust L* range is scaled to on an un-normalized image
+    INPUTS:
+    bg_mean (numpy Array): the mean linear RGB color of the background, ex. from sampled_background_mean
+    OUTPUTS:
+    bg_L (float): the L* of that color, 100 for a white background
+    """
+    L, _, _ = convert_to_lab(linear_to_srgb(np.clip(np.asarray(bg_mean, dtype=np.float64), 0, 1))[None])
+    return float(L[0])
+
+def white_rust_band(bg_L=100):
+    """
+    The L* range of white rust for a background at L* bg_L, WHITE_RUST_L scaled from the normalized background at 100
+    """
+    return WHITE_RUST_L[0] * bg_L / 100, WHITE_RUST_L[1] * bg_L / 100
+
+def gather_part_pixels(image, part_masks):
+    """
+    Gathers the pixels under every part mask into one array so that later color steps only work on the pixels the metrics use
+    INPUTS:
+    image (numpy Array): A numpy array representing the image to be analyzed
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    OUTPUTS:
+    pixels (numpy Array): A (N, 3) array of the pixels of all the parts, one part after another
+    part_sizes (list): the number of pixels of each part in pixels
+    """
+    gathered = [image[slc][pm] for slc, pm in iter_part_masks(part_masks)]
+    part_sizes = [len(p) for p in gathered]
+    if gathered:
+        pixels = np.concatenate(gathered)
+    else:
+        pixels = np.empty((0, image.shape[-1]), dtype=image.dtype)
+    return pixels, part_sizes
+
+def gather_part_interiors(part_masks, margin=RUST_EDGE_MARGIN):
+    """
+    Flags which of the gathered part pixels are inside the parts, away from their outline (see part_interior)
+    INPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    margin (int): width in pixels of the band along the outline of each part that is not inside
+    OUTPUTS:
+    interior (bool numpy Array): one flag per pixel, in the order of gather_part_pixels
+    """
+    gathered = [part_interior(pm, margin)[pm] for _, pm in iter_part_masks(part_masks)]
+    return np.concatenate(gathered) if gathered else np.empty(0, dtype=bool)
+
+def split_lab_parts(L, a, b, part_sizes):
+    """
+    Splits the L, a, b of the gathered part pixels back into each part, the sparse counterpart of get_lab_parts
+    INPUTS:
+    L (numpy Array): A numpy array consisting of the L value of each gathered pixel
+    a (numpy Array): A numpy array consisting of the a value of each gathered pixel
+    b (numpy Array): A numpy array consisting of the b value of each gathered pixel
+    part_sizes (list): the number of pixels of each part from gather_part_pixels
+    OUTPUTS:
+    part_lab (list): A list containing tuples of arrays that represent the L, a, and b values of each pixel of each part
+    """
+    bounds = np.cumsum([0] + list(part_sizes))
+    return [(L[s:e], a[s:e], b[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+
 def get_lab_parts(L, a, b, part_masks):
     """
     Takes in the L, a, b of the whole image and the masks of all the parts and divides the L a and b values to each part respectively
@@ -39,14 +177,14 @@ def get_lab_parts(L, a, b, part_masks):
     L (numpy Array): A numpy array consisting of the L value of each pixel of the whole image
     a (numpy Array): A numpy array consisting of the a value of each pixel of the whole image
     b (numpy Array): A numpy array consisting of the b value of each pixel of the whole image
-    part_masks (bool numpy Array): list containing a numpy array consisting of bools that act as the mask for each of the parts
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
     OUTPUTS:
     part_lab (list): A list containing tuples of arrays that represent the L, a, and b values of each pixel of each part
 
     """
     part_lab = []
-    for pm in part_masks:
-        part_lab.append((L[pm], a[pm], b[pm]))
+    for slc, pm in iter_part_masks(part_masks):
+        part_lab.append((L[slc][pm], a[slc][pm], b[slc][pm]))
     return part_lab
 
 def lab_normalize_from_bg(L, a, b, bg_mask, part_masks):
@@ -57,7 +195,7 @@ def lab_normalize_from_bg(L, a, b, bg_mask, part_masks):
     a (numpy Array): A numpy array consisting of the a value of each pixel of the whole image
     b (numpy Array): A numpy array consisting of the b value of each pixel of the whole image
     bg_mask (bool NumPy Array): A numpy array containing bools that act as the mask for the background
-    part_masks (bool numpy Array): list containing a numpy array consisting of bools that act as the mask for each of the parts
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
     OUTPUTS:
     normalized (list): A list containing tuples of arrays that represent the L, a, and b values of each pixel of each part but normalized
     """
@@ -66,38 +204,52 @@ def lab_normalize_from_bg(L, a, b, bg_mask, part_masks):
     b_ref = np.median(b[bg_mask])
 
     normalized = []
-    for pm in part_masks:
-        normalized.append((L[pm] - L_ref, a[pm] - a_ref, b[pm] - b_ref))
+    for slc, pm in iter_part_masks(part_masks):
+        normalized.append((L[slc][pm] - L_ref, a[slc][pm] - a_ref, b[slc][pm] - b_ref))
     return normalized
 
-def compute_metrics(normalized_parts):
+def compute_metrics(normalized_parts, bg_L=100, interiors=None):
     """
     Computes the relevent responses from primary analysis form a list of parts with L a and b values dedicated to each
     INPUTS:
     normalized_parts (list): A list containing tuples of arrays that represent the L, a, and b values of each pixel of each part but normalized
+    bg_L (float): L* of the background, 100 for a normalized image. The white rust L* range is WHITE_RUST_L scaled
+                  by bg_L / 100 (see white_rust_band), the chroma and red rust thresholds are not scaled
+    interiors (list): which pixels of each part are inside it (see part_interior), the corrosion fractions are
+                      taken on those of the diffuse pixels only. None takes them on all the diffuse pixels
     OUTPUTS:
     blackness (list): A list of calculated blackness values for each part
     color_shift (list): A list of calculated color shift values for each part
     a_shift (list): A list of calculated median a shift values for each part
     b_shift (list): A list of calculated median b shift values for each part
     gloss (list): A list of calculated gloss score values for each part
+    red_rust (list): A list of the fraction of each part's diffuse pixels that are red rust
+    white_rust (list): A list of the fraction of each part's diffuse pixels that are white rust
     """
     blackness = []
     color_shift = []
     a_shift = []
     b_shift = []
     gloss = []
+    red_rust = []
+    white_rust = []
+    white_L = white_rust_band(bg_L)
 
-    for (L, a, b) in normalized_parts:
-        high_L = np.percentile(L, 95)
+    for i, (L, a, b) in enumerate(normalized_parts):
+        high_L = np.percentile(L, HIGHLIGHT_PERCENTILE)
         diffuse_mask = L < high_L
         Ld = L[diffuse_mask]
         ad = a[diffuse_mask]
         bd = b[diffuse_mask]
-        blackness.append(np.percentile(Ld, 10))
+        blackness.append(np.percentile(Ld, BLACKNESS_PERCENTILE))
         color_shift.append(np.sqrt(np.mean(ad**2 + bd**2)))
         a_shift.append(np.median(ad))
         b_shift.append(np.median(bd))
+        inner = diffuse_mask if interiors is None else diffuse_mask & interiors[i]
+        Li, ai, bi = L[inner], a[inner], b[inner]
+        red_rust.append(np.mean((ai > RED_RUST_MIN_A) & (bi > RED_RUST_MIN_B)))
+        light = (Li > white_L[0]) & (Li < white_L[1])
+        white_rust.append(np.mean(light & (ai**2 + bi**2 < WHITE_RUST_MAX_CHROMA**2)))
         highlight_mask = L > high_L
         fraction = np.mean(highlight_mask)
 
@@ -107,4 +259,125 @@ def compute_metrics(normalized_parts):
             intensity = 0
         gloss_score = fraction * intensity
         gloss.append(gloss_score)
-    return blackness, color_shift, a_shift, b_shift, gloss
+    return blackness, color_shift, a_shift, b_shift, gloss, red_rust, white_rust
+
+def _select_percentile(values, q, count=None):
+    """
+    Linear interpolated percentile (same as np.percentile) by partitioning values in place
+    INPUTS:
+    values (numpy Array): the values, reordered in place
+    q (float): the percentile [0, 100]
+    count (int): the percentile of only the count smallest values, defaults to all of values
+    OUTPUTS:
+    percentile (float): the percentile of the values, nan if there are none
+    """
+    n = len(values) if count is None else count
+    if n == 0:
+        return np.nan
+    virtual = (n - 1) * (q / 100)
+    lo = int(np.floor(virtual))
+    hi = min(lo + 1, n - 1)
+    values.partition([lo, hi])
+    t = virtual - lo
+    low, high = values[lo], values[hi]
+    diff = high - low
+    # same rounding as numpy's interpolation
+    return high - diff * (1 - t) if t >= 0.5 else low + diff * t
+
+def _select_median(values):
+    """
+    Median (same as np.median) by partitioning values in place
+    """
+    n = len(values)
+    if n == 0:
+        return np.nan
+    if n % 2:
+        values.partition(n // 2)
+        return values[n // 2]
+    values.partition([n // 2 - 1, n // 2])
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+def compute_metrics_batched(L, a, b, part_sizes, bg_L=100, interior=None):
+    """
+    Computes the same responses as compute_metrics straight from the gathered part pixels, using
+    selection instead of np.percentile / np.median so each part's L values are copied once.
+    The diffuse pixels are the smallest L values of the part, so their 10th percentile comes from the
+    same partitioned copy as the 95th percentile, and the highlights are read from its top end.
+    Results match compute_metrics to floating point rounding (within 1e-9 relative for float64 input,
+    1e-6 for float32, the corrosion fractions exactly). A part with no diffuse pixels (all its L values
+    equal, ex. a single pixel) makes compute_metrics raise, here its metrics are nan and its gloss 0.
+    The corrosion pixels are counted from the diffuse a* and b* values the color metrics gather anyway,
+    white rust only looks at the a* and b* of the few light pixels.
+    INPUTS:
+    L (numpy Array): A numpy array consisting of the L value of each gathered pixel
+    a (numpy Array): A numpy array consisting of the a value of each gathered pixel
+    b (numpy Array): A numpy array consisting of the b value of each gathered pixel
+    part_sizes (list): the number of pixels of each part from gather_part_pixels
+    bg_L (float): L* of the background, 100 for normalized pixels, from background_lightness for the
+                  un-normalized pixels of the batch analysis (the white rust L* range is scaled to it)
+    interior (bool numpy Array): which gathered pixels are inside their part, from gather_part_interiors. The
+                                 corrosion fractions are taken on those of the diffuse pixels only, None takes
+                                 them on all the diffuse pixels
+    OUTPUTS:
+    blackness (list): A list of calculated blackness values for each part
+    color_shift (list): A list of calculated color shift values for each part
+    a_shift (list): A list of calculated median a shift values for each part
+    b_shift (list): A list of calculated median b shift values for each part
+    gloss (list): A list of calculated gloss score values for each part
+    red_rust (list): A list of the fraction of each part's diffuse pixels that are red rust
+    white_rust (list): A list of the fraction of each part's diffuse pixels that are white rust
+    """
+    blackness = []
+    color_shift = []
+    a_shift = []
+    b_shift = []
+    gloss = []
+    red_rust = []
+    white_rust = []
+    white_L = white_rust_band(bg_L)
+
+    bounds = np.cumsum([0] + list(part_sizes))
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        Lp = L[s:e]
+        work = Lp.copy()
+        high_L = _select_percentile(work, HIGHLIGHT_PERCENTILE)
+        diffuse_mask = Lp < high_L
+        n_diffuse = np.count_nonzero(diffuse_mask)
+
+        # every value above the 95th percentile is past the diffuse count after the partition
+        tail = work[n_diffuse:]
+        highlights = tail[tail > high_L]
+        if len(highlights):
+            intensity = highlights.sum() / len(highlights)
+        else:
+            intensity = 0
+        gloss.append(len(highlights) / len(Lp) * intensity)
+
+        blackness.append(_select_percentile(work, BLACKNESS_PERCENTILE, count=n_diffuse))
+
+        ad = a[s:e][diffuse_mask]
+        bd = b[s:e][diffuse_mask]
+        if n_diffuse:
+            color_shift.append(np.sqrt((np.dot(ad, ad) + np.dot(bd, bd)) / n_diffuse))
+        else:
+            color_shift.append(np.nan)
+        inner = diffuse_mask if interior is None else diffuse_mask & interior[s:e]
+        n_inner = n_diffuse if interior is None else np.count_nonzero(inner)
+        if n_inner:
+            # rust is rare on most parts, so one comparison over the part picks the few candidates to check further
+            red = np.flatnonzero(ad > RED_RUST_MIN_A)
+            if interior is not None:
+                red = red[inner[diffuse_mask][red]]
+            n_red = np.count_nonzero(bd[red] > RED_RUST_MIN_B)
+            light = np.flatnonzero(Lp > white_L[0])
+            light = light[(Lp[light] < white_L[1]) & inner[light]]
+            al, bl = a[s:e][light], b[s:e][light]
+            n_white = np.count_nonzero(al**2 + bl**2 < WHITE_RUST_MAX_CHROMA**2)
+            red_rust.append(n_red / n_inner)
+            white_rust.append(n_white / n_inner)
+        else:
+            red_rust.append(np.nan)
+            white_rust.append(np.nan)
+        a_shift.append(_select_median(ad))
+        b_shift.append(_select_median(bd))
+    return blackness, color_shift, a_shift, b_shift, gloss, red_rust, white_rust
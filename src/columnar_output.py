@@ -0,0 +1,106 @@
+"""
+Columnar (Parquet or Arrow IPC) output of batch metrics.
+
+The metrics of a batch are written as a dataset directory of files with typed columns, optionally
+partitioned Hive style (ex. date=2024-05-01/) by the date (UTC) the images were taken or by lot, which
+loads back into pandas much faster than the combined CSV:
+
+    df = read_metrics_dataset('output/metrics_dataset')
+
+pyarrow is only needed when this output is used.
+"""
+import os
+import time
+import pandas as pd
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+PARTITION_KEYS = ('date', 'lot')
+DATASET_DIR = 'metrics_dataset'
+FILE_ROWS = 100_000       # rows buffered before they are written out as a file
+ROW_GROUP_ROWS = 10_000   # rows per Parquet row group / Arrow record batch
+
+_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError('Parquet and Arrow output needs pyarrow, install it with: pip install pyarrow') from None
+    return pyarrow
+
+def check_columnar_options(fmt, partition_by=None):
+    """
+    Checks the columnar output options and that pyarrow is installed, so a batch fails before any image is analyzed
+    INPUTS:
+    fmt (str): 'parquet' or 'arrow'
+    partition_by (str): None, 'date' or 'lot'
+    """
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError(f'Unknown columnar format {fmt!r}, expected one of {COLUMNAR_FORMATS}')
+    if partition_by is not None and partition_by not in PARTITION_KEYS:
+        raise ValueError(f'Unknown partition key {partition_by!r}, expected None or one of {PARTITION_KEYS}')
+    _pyarrow()
+
+def _partition_values(df, partition_by):
+    if partition_by == 'date':
+        return df['timestamp'].dt.strftime('%Y-%m-%d')
+    return df['lot'].astype(str)
+
+def write_dataset_files(frames, dataset_dir, fmt='parquet', partition_by=None):
+    """
+    Writes the metrics of a run of images as new files of a columnar dataset, one per partition
+    INPUTS:
+    frames (list): metric tables from build_results_table with the image columns (group, image_hash, timestamp, lot)
+    dataset_dir (str): directory of the dataset
+    fmt (str): 'parquet' or 'arrow'
+    partition_by (str): None for one file, or 'date' / 'lot' to write each date or lot into its own subdirectory
+    OUTPUTS:
+    paths (list): the files written
+    """
+    pa = _pyarrow()
+    if not frames:
+        return []
+    df = pd.concat(frames, ignore_index=True)
+    # float32 pipeline runs give float32 metrics, the dataset keeps one schema across runs
+    df = df.astype({c: 'float64' for c in df.select_dtypes('floating').columns})
+    if partition_by is None:
+        groups = [(None, df)]
+    else:
+        # the partition column lives in the directory name, not in the files
+        groups = df.groupby(_partition_values(df, partition_by), sort=True)
+        groups = [(key, part.drop(columns=['lot'] if partition_by == 'lot' else [])) for key, part in groups]
+
+    # unique per writer, so several runs can add to the same dataset
+    stem = f'part-{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{time.perf_counter_ns()}'
+    paths = []
+    for key, part in groups:
+        directory = dataset_dir if key is None else os.path.join(dataset_dir, f'{partition_by}={key}')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, stem + _EXTENSIONS[fmt])
+        table = pa.Table.from_pandas(part, preserve_index=False)
+        # hidden until complete, dataset readers skip files starting with a dot
+        tmp_path = os.path.join(directory, f'.{stem}.tmp')
+        if fmt == 'parquet':
+            pa.parquet.write_table(table, tmp_path, row_group_size=ROW_GROUP_ROWS)
+        else:
+            with pa.ipc.new_file(tmp_path, table.schema) as writer:
+                writer.write_table(table, max_chunksize=ROW_GROUP_ROWS)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+def read_metrics_dataset(dataset_dir, fmt='parquet'):
+    """
+    Loads a metrics dataset written by a batch run into one table, including its partition column
+    INPUTS:
+    dataset_dir (str): directory of the dataset
+    fmt (str): 'parquet' or 'arrow'
+    OUTPUTS:
+    df (pandas DataFrame): the metrics of every image in the dataset
+    """
+    _pyarrow()
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(dataset_dir, format='ipc' if fmt == 'arrow' else 'parquet', partitioning='hive')
+    return dataset.to_table().to_pandas()
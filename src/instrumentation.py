@@ -0,0 +1,134 @@
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# the record of the image being profiled in this process, None when profiling is off
+_active = None
+# per-thread progress callbacks, so analyses running in different threads each report their own stages
+_progress = threading.local()
+
+@contextmanager
+def profile_image(image_name, memory=True):
+    """
+    Turns on per-stage timing (and memory tracking) for everything analyzed inside the with block
+    INPUTS:
+    image_name (str): name of the image the record is for
+    memory (bool): also record the peak memory allocated in each stage, this slows the stages down
+    OUTPUTS:
+    record (dict): filled in as the stages run, with the image name, total time, per-stage
+                   time_s and peak_bytes, and any values recorded with record_value
+    """
+    global _active
+    record = {'image': image_name, 'total_s': 0.0, 'stages': {}, 'values': {}}
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    record['memory'] = tracemalloc.is_tracing()
+    previous, _active = _active, record
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['total_s'] = time.perf_counter() - start
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+@contextmanager
+def report_progress(callback):
+    """
+    Calls callback with the name of each stage as it starts, for everything analyzed in this thread inside the with block
+    INPUTS:
+    callback (callable): called as callback(stage_name)
+    """
+    previous = getattr(_progress, 'callback', None)
+    _progress.callback = callback
+    try:
+        yield
+    finally:
+        _progress.callback = previous
+
+@contextmanager
+def stage(name):
+    """
+    Times one stage of the pipeline into the active record, does nothing when no image is being profiled
+    INPUTS:
+    name (str): name of the stage, ex. 'load' or 'threshold'
+    """
+    callback = getattr(_progress, 'callback', None)
+    if callback is not None:
+        callback(name)
+    record = _active
+    if record is None:
+        yield
+        return
+    if record['memory']:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - base if record['memory'] else None
+        entry = record['stages'].setdefault(name, {'time_s': 0.0, 'peak_bytes': None})
+        entry['time_s'] += elapsed
+        if peak is not None:
+            entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak)
+
+def record_value(name, value):
+    """
+    Saves a diagnostic value (ex. the background threshold) into the active record instead of printing it
+    """
+    if _active is not None:
+        _active['values'][name] = value
+
+def records_to_frame(records):
+    """
+    Flattens profile records into one row per image and stage
+    INPUTS:
+    records (list): records from profile_image
+    OUTPUTS:
+    df (pandas DataFrame): columns image, stage, time_s and peak_bytes
+    """
+    # pandas is only needed for reports, the stages themselves are timed without it
+    import pandas as pd
+    rows = []
+    for record in records:
+        for name, entry in record['stages'].items():
+            rows.append({'image': record['image'], 'stage': name, **entry})
+        rows.append({'image': record['image'], 'stage': 'total', 'time_s': record['total_s'], 'peak_bytes': None})
+    return pd.DataFrame(rows, columns=['image', 'stage', 'time_s', 'peak_bytes'])
+
+def summarize_records(records):
+    """
+    Aggregates profile records of a batch run per stage
+    INPUTS:
+    records (list): records from profile_image
+    OUTPUTS:
+    summary (pandas DataFrame): per stage count, total, mean and max time, and max peak memory, slowest stage first
+    """
+    df = records_to_frame(records)
+    summary = df.groupby('stage', sort=False).agg(
+        images=('time_s', 'size'),
+        total_s=('time_s', 'sum'),
+        mean_s=('time_s', 'mean'),
+        max_s=('time_s', 'max'),
+        max_peak_mb=('peak_bytes', lambda b: b.max() / 1024**2),
+    )
+    return summary.sort_values('total_s', ascending=False)
+
+def export_records(records, path):
+    """
+    Writes profile records to a .json file (full records) or a .csv file (one row per image and stage)
+    INPUTS:
+    records (list): records from profile_image
+    path (str): output file path, the format is picked by its extension
+    """
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=2, default=float)
+    else:
+        records_to_frame(records).to_csv(path, index=False)
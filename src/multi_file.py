@@ -1,40 +1,650 @@
 import os
-import gc
+import io
+import json
+import hashlib
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
 import pandas as pd
+from skimage.io import imread
 from analysis_core import analyze_image_core_batch
+from result_cache import CACHE_STATS, DEFAULT_MAX_BYTES, image_hash
+from utils import build_results_table
+from columnar_output import DATASET_DIR, FILE_ROWS, check_columnar_options, write_dataset_files
+from calibration import load_calibration
+from tiled_analysis import check_downscale
+from instrumentation import profile_image, summarize_records, export_records
 
-def analyze_images_in_directory(image_directory, output_directory):
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+MANIFEST_NAME = "manifest.jsonl"
+READ_AHEAD = 2          # images read and decoded ahead of the analysis
+WRITE_QUEUE_SIZE = 64   # analyzed images waiting for the writer before the analysis waits for it
+WRITE_BATCH = 32        # most images written to the combined CSV in one append
+ANNOTATION_SIZE = 2000  # longest side in pixels of the numbered parts images of a batch
+MANIFEST_BLOCK = 65536  # bytes read at a time when looking back for the last complete line of the manifest
+_DONE = object()        # end of stream marker of the pipeline queues
+
+# what the writer stage writes besides combined_metrics.csv, see analyze_images_in_directory
+DEFAULT_OUTPUTS = {'per_image_csv': True, 'columnar': None, 'partition_by': None, 'lot': None}
+
+def shard_of(filename, shard_count):
     """
-    Batch runner: no figures, streams metrics to a single CSV.
+    The shard an image belongs to, from a stable hash of its path relative to the image directory,
+    so every machine splits the same tree the same way without coordinating
+    INPUTS:
+    filename (str): path of the image relative to the image directory, with / separators (as list_images gives)
+    shard_count (int): number of shards
+    OUTPUTS:
+    shard (int): the shard index, 0 to shard_count - 1
+    """
+    digest = hashlib.sha256(filename.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+def parse_shard(shard):
+    """
+    Parses a shard given as 'index/count', ex. '0/4' for the first of four shards, or checks an (index, count) tuple
+    """
+    if isinstance(shard, str):
+        try:
+            index, count = (int(v) for v in shard.split('/'))
+        except ValueError:
+            raise ValueError(f'Expected a shard as index/count (ex. 0/4), got {shard!r}') from None
+    else:
+        index, count = shard
+    if not 0 <= index < count:
+        raise ValueError(f'Shard {index} of {count} does not exist, the shard index goes from 0 to {count - 1}')
+    return index, count
+
+def list_images(image_directory, recursive=False, shard=None, exclude=None):
+    """
+    Lists the image files in a directory in a deterministic (sorted) order
+    INPUTS:
+    image_directory (str): directory path containing the images
+    recursive (bool): also list the images in every subdirectory (hidden ones, ex. NFS .snapshot, are skipped)
+    shard (tuple): (index, count) or 'index/count' to only list the images of shard index of count (see shard_of),
+                   None for all
+    exclude (str): directory to leave out of a recursive listing, ex. an output directory inside the image directory
+    OUTPUTS:
+    filenames (list): sorted list of image file names in the directory, paths relative to it with / separators when recursive
+    """
+    if shard is not None:
+        index, count = parse_shard(shard)
+    if not recursive:
+        filenames = [f for f in os.listdir(image_directory) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        excluded = os.path.abspath(exclude) if exclude is not None else None
+        filenames = []
+        for root, dirnames, files in os.walk(image_directory):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) != excluded]
+            relative = os.path.relpath(root, image_directory)
+            prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+            filenames.extend(prefix + f for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    if shard is not None:
+        filenames = [f for f in filenames if shard_of(f, count) == index]
+    return sorted(filenames)
+
+@lru_cache(maxsize=1)
+def _cached_calibration(calibration_path):
+    # each worker process loads the profile once instead of receiving its full-frame mask with every image
+    return load_calibration(calibration_path)
+
+def _output_path(output_directory, filename, suffix):
+    """
+    Path of a per-image output file, in the same subdirectory of the output directory as the image is in the image directory
+    """
+    base = os.path.splitext(filename)[0]
+    path = os.path.join(output_directory, *base.split('/')) + suffix
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def _analyze_file(image_path, profile=None, calibration_path=None, image_input=None, hash_image=False,
+                  annotation_dir=None, image_root=None, **kwargs):
+    """
+    Worker for a single image. Errors are returned instead of raised so one bad file
+    (ex. a corrupt JPEG) does not stop the rest of the batch.
+    INPUTS:
+    image_path (str): file path of the image to be analyzed
+    profile (str): None for no profiling, 'time' for per-stage times, 'memory' for times and peak memory
+    calibration_path (str): file path of a lightbox calibration profile, None for no calibration
+    image_input (file-like): the bytes of the image already read from image_path, None to read the file
+    hash_image (bool): attach the content hash of the image to the metrics (df.attrs['image_hash'])
+    annotation_dir (str): directory to save the numbered parts image of the image to, None to not draw it
+    image_root (str): the image directory, the numbered parts image goes in the same subdirectory of annotation_dir
+                      as the image is in it
+    kwargs: options passed on to analyze_image_core_batch (including an already decoded image)
+    OUTPUTS:
+    df (pandas DataFrame or None): the metrics of the image, None if it failed
+    error (str or None): the error message if the image failed
+    cached (bool): whether the metrics came from the result cache
+    record (dict or None): the per-stage profile record of the image
+    """
+    hits = CACHE_STATS['hits']
+    record = None
+    try:
+        if calibration_path is not None:
+            kwargs['calibration'] = _cached_calibration(calibration_path)
+        if image_input is None:
+            image_input = image_path
+        if annotation_dir is not None:
+            name = os.path.basename(image_path) if image_root is None else os.path.relpath(image_path, image_root)
+            kwargs['annotation_path'] = _output_path(annotation_dir, name.replace(os.sep, '/'), '_numbered.jpg')
+        if profile is None:
+            df = analyze_image_core_batch(image_input, **kwargs)
+        else:
+            with profile_image(os.path.basename(image_path), memory=profile == 'memory') as record:
+                df = analyze_image_core_batch(image_input, **kwargs)
+        if hash_image and 'image_hash' not in df.attrs:
+            df.attrs['image_hash'] = image_hash(image_input)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}', False, record
+    return df, None, CACHE_STATS['hits'] > hits, record
+
+def _file_identity(image_path):
+    """
+    Size and modification time of a file, a changed file is treated as a new one
+    """
+    st = os.stat(image_path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_manifest(output_directory):
+    """
+    Loads the record of the files already processed into an output directory
+    INPUTS:
+    output_directory (str): directory path where the csv files and manifest are stored
+    OUTPUTS:
+    manifest (dict): the latest manifest record of each file name
+    """
+    manifest = {}
+    manifest_path = os.path.join(output_directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by an interrupted run
+                continue
+            manifest[record['file']] = record
+    return manifest
+
+def _drop_partial_manifest_line(manifest_path):
+    """
+    Cuts off a manifest line left unfinished by an interrupted run (load_manifest skips it), so that the next
+    record appended starts on a line of its own instead of running on from it
+    """
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return
+        # back to the end of the last complete line, reading the file backwards a block at a time
+        while end > 0:
+            start = max(0, end - MANIFEST_BLOCK)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+def _truncate_to_manifest(combined_path, manifest):
+    """
+    Drops rows appended to the combined CSV after the last manifest record, so an interrupted
+    image is not in the CSV twice once it is processed again
+    """
+    if not manifest or not os.path.exists(combined_path):
+        # without a manifest there is no way to tell which rows are complete, so leave the file alone
+        return
+    offset = max((r['csv_offset'] for r in manifest.values()), default=0)
+    if os.path.getsize(combined_path) > offset:
+        with open(combined_path, 'r+b') as f:
+            f.truncate(offset)
+
+def _pending_files(image_directory, manifest, min_age=0.0, recursive=False, shard=None, exclude=None):
+    """
+    Lists the images that are not in the manifest yet, or that changed since they were processed
+    INPUTS:
+    image_directory (str): directory path containing the images
+    manifest (dict): the manifest records from load_manifest
+    min_age (float): seconds since the last modification before a file is picked up, so files still being written are skipped
+    recursive, shard, exclude: which images to list, see list_images
+    OUTPUTS:
+    filenames (list): sorted list of image file names to process
+    """
+    now = time.time()
+    pending = []
+    for filename in list_images(image_directory, recursive=recursive, shard=shard, exclude=exclude):
+        try:
+            identity = _file_identity(os.path.join(image_directory, filename))
+        except FileNotFoundError:
+            continue
+        if now - identity[1] / 1e9 < min_age:
+            continue
+        record = manifest.get(filename)
+        if record is None or record['identity'] != identity:
+            pending.append(filename)
+    return pending
+
+def _put(q, item, stop):
+    """
+    Puts an item on a bounded queue, waiting while it is full (backpressure) unless the pipeline is stopped
+    OUTPUTS:
+    put (bool): False if the pipeline stopped before there was room for the item
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    """
+    Takes the next item off a queue, waiting for it unless the pipeline is stopped
+    OUTPUTS:
+    item: the item, None if the pipeline stopped first
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _read_ahead(image_paths, depth, decode, stop):
+    """
+    Reads (and decodes) images in a background thread, at most depth images ahead of the analysis
+    INPUTS:
+    image_paths (list): file paths of the images in processing order
+    depth (int): number of images read ahead, this bounds the memory the stage uses
+    decode (bool): decode the images (to 8-bit, the conversion to the pipeline mode is left to the analysis)
+                   instead of only reading the file bytes
+    stop (threading.Event): set to stop reading
+    OUTPUTS:
+    items: for each image, either the file bytes (BytesIO) or the decoded image, or the read error
+    """
+    q = queue.Queue(maxsize=depth)
+
+    def reader():
+        for path in image_paths:
+            try:
+                if decode:
+                    item = (None, imread(path), None)
+                else:
+                    with open(path, 'rb') as f:
+                        item = (io.BytesIO(f.read()), None, None)
+            except Exception as e:
+                item = (None, None, f'{type(e).__name__}: {e}')
+            if not _put(q, item, stop):
+                return
+        _put(q, _DONE, stop)
+
+    threading.Thread(target=reader, name='read-ahead', daemon=True).start()
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        yield item
+
+def _columnar_frame(df, filename, identity, lot):
+    """
+    The metrics of one image with the typed image columns of the columnar dataset
+    """
+    return build_results_table(
+        df['Blackness'], df['Color Shift'], df['Median a*'], df['Median b*'], df['Gloss Factor'],
+        df['Red Rust Fraction'], df['White Rust Fraction'],
+        group=os.path.splitext(filename)[0],
+        image_hash=df.attrs['image_hash'],
+        timestamp=pd.Timestamp(identity[1], unit='ns', tz='UTC'),
+        lot=lot
+    )
+
+def _write_results(write_queue, output_directory, manifest, totals, stop, outputs=DEFAULT_OUTPUTS):
+    """
+    Writer stage: appends the metrics of finished images to the combined CSV and the manifest in input order.
+    The rows of all the images waiting in the queue are written together, so the writes batch up whenever the
+    writer falls behind. With columnar output the rows are also buffered into files of up to FILE_ROWS rows,
+    and the manifest lines of the images wait until their file is written. Runs in its own thread and fills in totals.
     """
-    os.makedirs(output_directory, exist_ok=True)
     combined_path = os.path.join(output_directory, "combined_metrics.csv")
-    first_write = True
+    manifest_path = os.path.join(output_directory, MANIFEST_NAME)
+    dataset_dir = os.path.join(output_directory, DATASET_DIR)
+    first_write = not os.path.exists(combined_path) or os.path.getsize(combined_path) == 0
+    _drop_partial_manifest_line(manifest_path)
+    columnar_frames = []
+    columnar_rows = 0
+    pending_entries = []
 
-    for filename in os.listdir(image_directory):
-        if filename.lower().endswith(('.jpg', '.png', '.jpeg')):
-            print("Processing:", filename)
-            image_path = os.path.join(image_directory, filename)
+    done = False
+    while not done:
+        item = _get(write_queue, stop)
+        if item is None:
+            # the pipeline stopped early, what is left in the queue is not written
+            return
+        batch = [item]
+        while len(batch) < WRITE_BATCH and not write_queue.empty():
+            batch.append(write_queue.get())
+        if batch[-1] is _DONE:
+            batch.pop()
+            done = True
 
-            df = analyze_image_core_batch(image_path)
+        frames = []
+        entries = []
+        for filename, identity, (df, error, cached, record) in batch:
+            if record is not None:
+                totals['records'].append(record)
+            entry = {
+                'file': filename,
+                'identity': identity,
+                'status': 'failed' if error is not None else 'ok',
+            }
+            if error is not None:
+                print(f"Skipping {filename}: {error}")
+                totals['failed'].append(filename)
+            else:
+                base = os.path.splitext(filename)[0]
+                if 'background_drift' in df.attrs:
+                    entry['background_drift'] = df.attrs['background_drift']
+                    entry['drifted'] = df.attrs['drifted']
+                    if df.attrs['drifted']:
+                        print(f"WARNING: the background of {filename} drifted {df.attrs['background_drift']:.1%} "
+                              "from the calibration profile")
+                        totals['drifted'].append(filename)
+                if outputs['columnar'] is not None:
+                    columnar_frames.append(_columnar_frame(df, filename, identity, outputs['lot']))
+                    columnar_rows += len(df)
+                df["group"] = base
+                frames.append(df)
 
-            base = os.path.splitext(filename)[0]
-            df["group"] = base
+                if outputs['per_image_csv']:
+                    df.to_csv(_output_path(output_directory, filename, "_metrics.csv"), index=False)
+                totals['processed'] += 1
+                totals['cache_hits'] += cached
+            entries.append(entry)
 
-            # append to combined CSV incrementally
-            df.to_csv(
+        if frames:
+            # one append to the combined CSV for the whole batch
+            pd.concat(frames, ignore_index=True).to_csv(
                 combined_path,
                 mode="a",
                 header=first_write,
                 index=False
             )
             first_write = False
+        csv_offset = os.path.getsize(combined_path) if os.path.exists(combined_path) else 0
+        for entry in entries:
+            entry['csv_offset'] = csv_offset
+        pending_entries.extend(entries)
 
-            # optional: also save per-image metrics
-            df.to_csv(
-                os.path.join(output_directory, f"{base}_metrics.csv"),
-                index=False
-            )
+        if outputs['columnar'] is not None:
+            if columnar_rows < FILE_ROWS and not done:
+                continue
+            write_dataset_files(columnar_frames, dataset_dir, outputs['columnar'], outputs['partition_by'])
+            columnar_frames = []
+            columnar_rows = 0
+
+        # the manifest lines are written after the rows, so a file is only skipped once its rows are saved
+        with open(manifest_path, 'a') as f:
+            for entry in pending_entries:
+                f.write(json.dumps(entry) + '\n')
+                manifest[entry['file']] = entry
+        pending_entries = []
+
+def _process_files(filenames, image_directory, output_directory, analyze, executor, manifest, workers=1, decode=True,
+                   outputs=DEFAULT_OUTPUTS):
+    """
+    Analyzes a list of images and appends their metrics to the combined CSV and the manifest in input order.
+    Runs as a pipeline: a read-ahead thread (in-process runs only, worker processes read their own images),
+    the analysis, and a writer thread, connected by bounded queues so memory stays flat for any number of images.
+    INPUTS:
+    workers (int): number of worker processes of the executor, twice as many images are kept in flight
+    decode (bool): decode the images in the read-ahead thread, False to only read the file bytes ahead
+                   (ex. with the result cache on, where a hit needs no decoding)
+    outputs (dict): what to write besides combined_metrics.csv, see DEFAULT_OUTPUTS
+    OUTPUTS:
+    processed (int): number of images analyzed
+    failed (list): file names of the images that could not be analyzed
+    cache_hits (int): number of images whose metrics came from the result cache
+    records (list): the profile records of the images that were profiled
+    drifted (list): file names of the images whose background drifted from the calibration profile
+    """
+    image_paths = [os.path.join(image_directory, f) for f in filenames]
+    identities = [_file_identity(p) for p in image_paths]
+
+    totals = {'processed': 0, 'failed': [], 'cache_hits': 0, 'records': [], 'drifted': []}
+    stop = threading.Event()
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer_error = []
+
+    def writer():
+        try:
+            _write_results(write_queue, output_directory, manifest, totals, stop, outputs)
+        except BaseException as e:
+            writer_error.append(e)
+            stop.set()
+
+    writer_thread = threading.Thread(target=writer, name='writer', daemon=True)
+    writer_thread.start()
+
+    def submit(filename, identity, result):
+        if not _put(write_queue, (filename, identity, result), stop):
+            raise writer_error[0] if writer_error else RuntimeError('The writer stage stopped')
+
+    try:
+        if executor is not None:
+            # a window of submitted images instead of executor.map, which would queue up every image at once
+            window = collections.deque()
+            for filename, identity, path in zip(filenames, identities, image_paths):
+                print("Processing:", filename)
+                window.append((filename, identity, executor.submit(analyze, path)))
+                if len(window) >= 2 * workers:
+                    filename, identity, future = window.popleft()
+                    submit(filename, identity, future.result())
+            while window:
+                filename, identity, future = window.popleft()
+                submit(filename, identity, future.result())
+        else:
+            items = _read_ahead(image_paths, READ_AHEAD, decode, stop)
+            for filename, identity, path, (image_input, image, error) in zip(filenames, identities, image_paths, items):
+                print("Processing:", filename)
+                if error is not None:
+                    result = (None, error, False, None)
+                else:
+                    result = analyze(path, image_input=image_input, image=image)
+                del image_input, image
+                submit(filename, identity, result)
+        _put(write_queue, _DONE, stop)
+        writer_thread.join()
+    finally:
+        stop.set()
+    if writer_error:
+        raise writer_error[0]
+    return totals['processed'], totals['failed'], totals['cache_hits'], totals['records'], totals['drifted']
+
+def _batch_outputs(image_directory, per_image_csv, columnar, partition_by, lot):
+    """
+    Checks the output options of a batch and collects them for the writer stage
+    """
+    if columnar is not None:
+        check_columnar_options(columnar, partition_by)
+        if lot is None:
+            lot = os.path.basename(os.path.normpath(image_directory))
+    return {'per_image_csv': per_image_csv, 'columnar': columnar, 'partition_by': partition_by, 'lot': lot}
+
+def analyze_images_in_directory(image_directory, output_directory, workers=1, mode='float64', downscale=1,
+                                cache_dir=None, cache_labels=False, cache_max_bytes=DEFAULT_MAX_BYTES,
+                                resume=False, profile=None, profile_path=None,
+                                calibration_path=None, calibration_use='apply',
+                                per_image_csv=True, columnar=None, partition_by=None, lot=None,
+                                annotate=False, annotation_size=ANNOTATION_SIZE, memory_budget=None,
+                                recursive=False, shard=None):
+    """
+    Batch runner: no figures, streams metrics to a single CSV (and optionally a Parquet or Arrow dataset).
+    INPUTS:
+    image_directory (str): directory path containing the images to be analyzed
+    output_directory (str): directory path where the csv files will be stored
+    workers (int): number of worker processes, 1 runs everything in this process
+    mode (str): color pipeline mode, 'float64' (reference), 'float32' or 'lut' (see PIPELINE_MODES in utils)
+    downscale (int): downscale factor for the coarse segmentation pass, 1 segments at full resolution
+    cache_dir (str): directory of the result cache, None to analyze every image from scratch
+    cache_labels (bool): also store the part label image of each image in the cache
+    cache_max_bytes (int): size cap of the cache, least recently used entries are evicted past it
+    resume (bool): skip the images already recorded in the output directory's manifest (same name, size and modification time),
+                   failed images are only tried again once the file changes
+    profile (str): None for no profiling, 'time' for per-stage times, 'memory' for times and peak memory per stage
+    profile_path (str): .json or .csv file to export the per-image profile records to
+    calibration_path (str): file path of a lightbox calibration profile (see calibration.py), images whose
+                            background drifted from it are flagged in the output and the manifest
+    calibration_use (str): 'apply' to scale the white rust range to the profile's background instead of finding
+                           the background of each image, 'verify' to only check the drift
+    per_image_csv (bool): also write a <image name>_metrics.csv file per image
+    columnar (str): also write the metrics to a dataset in <output_directory>/metrics_dataset, 'parquet' or 'arrow'
+                    (needs pyarrow), with typed group, part, metric, image hash, timestamp and lot columns
+    partition_by (str): split the dataset into a directory per 'date' (the day the image file was written, UTC)
+                        or per 'lot', None for no partitioning
+    lot (str): lot number stored with every row of the dataset, defaults to the name of the image directory
+    annotate (bool): also save a <image name>_numbered.jpg image with the part numbers drawn on it
+    annotation_size (int): longest side in pixels of the numbered parts images, None for full resolution
+    memory_budget (int): analyze each image a band of rows at a time within this many bytes per worker, for very
+                         large images (needs downscale 2 or more, see tiled_analysis), None for in memory
+    recursive (bool): also analyze the images in every subdirectory, their outputs go in the same subdirectories
+                      of the output directory and their group is their path relative to image_directory
+    shard (tuple): (index, count) to only analyze the images of shard index of count, so several machines can each
+                   run one shard of the same tree into their own output directory (see shards.py to merge them)
+    OUTPUTS:
+    failed (list): file names of the images that could not be analyzed
+    """
+    outputs = _batch_outputs(image_directory, per_image_csv, columnar, partition_by, lot)
+    if memory_budget is not None:
+        check_downscale(downscale)
+    os.makedirs(output_directory, exist_ok=True)
+    combined_path = os.path.join(output_directory, "combined_metrics.csv")
+
+    manifest = load_manifest(output_directory)
+    if resume:
+        _truncate_to_manifest(combined_path, manifest)
+        filenames = _pending_files(image_directory, manifest, recursive=recursive, shard=shard, exclude=output_directory)
+        print(f"Resuming: {len(manifest)} images already processed, {len(filenames)} to go")
+    else:
+        filenames = list_images(image_directory, recursive=recursive, shard=shard, exclude=output_directory)
+
+    analyze = partial(
+        _analyze_file,
+        profile=profile,
+        hash_image=columnar is not None,
+        annotation_dir=output_directory if annotate else None,
+        image_root=image_directory,
+        annotation_size=annotation_size,
+        calibration_path=calibration_path,
+        calibration_use=calibration_use,
+        mode=mode,
+        downscale=downscale,
+        cache_dir=cache_dir,
+        cache_labels=cache_labels,
+        cache_max_bytes=cache_max_bytes,
+        memory_budget=memory_budget
+    )
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        processed, failed, cache_hits, records, drifted = _process_files(
+            filenames, image_directory, output_directory, analyze, executor, manifest,
+            workers=workers, decode=cache_dir is None and memory_budget is None, outputs=outputs
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed} images ({len(failed)} failed) in {elapsed:.1f} s: {rate:.2f} images/sec")
+    if cache_dir is not None:
+        print(f"Result cache: {cache_hits} hits, {processed - cache_hits} misses")
+    if calibration_path is not None:
+        print(f"Background drifted from the calibration profile in {len(drifted)} images: {', '.join(drifted) or 'none'}")
+    if records:
+        print(summarize_records(records).to_string())
+        if profile_path is not None:
+            export_records(records, profile_path)
+    return failed
+
+def watch_directory(image_directory, output_directory, poll_interval=2.0, settle_time=1.0, stop_after=None,
+                    workers=1, mode='float64', downscale=1,
+                    cache_dir=None, cache_labels=False, cache_max_bytes=DEFAULT_MAX_BYTES,
+                    calibration_path=None, calibration_use='apply',
+                    per_image_csv=True, columnar=None, partition_by=None, lot=None,
+                    annotate=False, annotation_size=ANNOTATION_SIZE, memory_budget=None,
+                    recursive=False, shard=None):
+    """
+    Watches a camera drop folder and analyzes images as they land, resuming from the manifest.
+    A new image gets its metrics row within about settle_time + poll_interval + its analysis time.
+    INPUTS:
+    image_directory (str): directory path the camera drops images into
+    output_directory (str): directory path where the csv files will be stored
+    poll_interval (float): seconds between checks of the directory
+    settle_time (float): seconds a file must be left unmodified before it is analyzed, so partly written files are skipped
+    stop_after (float): stop watching after this many seconds, None watches until interrupted (Ctrl+C)
+    workers, mode, downscale, cache_dir, cache_labels, cache_max_bytes, calibration_path, calibration_use,
+    per_image_csv, columnar, partition_by, lot, annotate, annotation_size, memory_budget, recursive, shard:
+        same as analyze_images_in_directory,
+        the columnar dataset gets a file per poll that found new images
+    OUTPUTS:
+    failed (list): file names of the images that could not be analyzed
+    """
+    outputs = _batch_outputs(image_directory, per_image_csv, columnar, partition_by, lot)
+    if memory_budget is not None:
+        check_downscale(downscale)
+    os.makedirs(output_directory, exist_ok=True)
+    combined_path = os.path.join(output_directory, "combined_metrics.csv")
+    manifest = load_manifest(output_directory)
+    _truncate_to_manifest(combined_path, manifest)
 
-            del df
-            gc.collect()
+    analyze = partial(
+        _analyze_file,
+        hash_image=columnar is not None,
+        annotation_dir=output_directory if annotate else None,
+        image_root=image_directory,
+        annotation_size=annotation_size,
+        calibration_path=calibration_path,
+        calibration_use=calibration_use,
+        mode=mode,
+        downscale=downscale,
+        cache_dir=cache_dir,
+        cache_labels=cache_labels,
+        cache_max_bytes=cache_max_bytes,
+        memory_budget=memory_budget
+    )
+    # one pool for the whole watch so the workers stay warm between polls
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    failed = []
+    start = time.monotonic()
+    print(f"Watching {image_directory} (Ctrl+C to stop)")
+    try:
+        while stop_after is None or time.monotonic() - start < stop_after:
+            filenames = _pending_files(image_directory, manifest, min_age=settle_time,
+                                       recursive=recursive, shard=shard, exclude=output_directory)
+            if filenames:
+                _, newly_failed, _, _, _ = _process_files(
+                    filenames, image_directory, output_directory, analyze, executor, manifest,
+                    workers=workers, decode=cache_dir is None and memory_budget is None, outputs=outputs
+                )
+                failed.extend(newly_failed)
+            else:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return failed
@@ -1,15 +1,36 @@
 import os
 from analysis_core import analyze_image_core
-from multi_file import analyze_images_in_directory
+from multi_file import analyze_images_in_directory, watch_directory
 
 def main():
     path = input('Enter input directory: ').strip()
     output_dir = input('Enter output directory path: ').strip()
+    recursive = input('Include images in subdirectories? (y/N): ').strip().lower() == 'y'
+    workers = input(f'Enter number of worker processes (1-{os.cpu_count()}, blank for 1): ').strip()
+    workers = int(workers) if workers else 1
+    cache_dir = input('Enter result cache directory (blank for no cache): ').strip() or None
+    resume = input('Skip images already processed into the output directory? (y/N): ').strip().lower() == 'y'
+    calibration_path = input('Enter calibration profile file (blank for none): ').strip() or None
+    calibration_use = 'apply'
+    if calibration_path is not None:
+        verify = input('Only verify the background against the profile instead of applying it? (y/N): ')
+        calibration_use = 'verify' if verify.strip().lower() == 'y' else 'apply'
+    columnar = input('Also write a Parquet or Arrow dataset? (parquet/arrow, blank for CSV only): ').strip().lower() or None
+    per_image_csv = input('Write a CSV file per image? (Y/n): ').strip().lower() != 'n'
+    annotate = input('Save an image with the part numbers drawn on it per image? (y/N): ').strip().lower() == 'y'
+    watch = input('Keep watching the input directory for new images? (y/N): ').strip().lower() == 'y'
 
     os.makedirs(output_dir, exist_ok=True)
 
-    analyze_images_in_directory(path, output_dir)
+    if watch:
+        watch_directory(path, output_dir, workers=workers, cache_dir=cache_dir,
+                        calibration_path=calibration_path, calibration_use=calibration_use,
+                        per_image_csv=per_image_csv, columnar=columnar, annotate=annotate, recursive=recursive)
+    else:
+        analyze_images_in_directory(path, output_dir, workers=workers, cache_dir=cache_dir, resume=resume,
+                                    calibration_path=calibration_path, calibration_use=calibration_use,
+                                    per_image_csv=per_image_csv, columnar=columnar, annotate=annotate, recursive=recursive)
     print('Analysis complete. Results saved to output directory.')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
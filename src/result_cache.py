@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+EVICT_TO = 0.9       # an eviction brings the cache down to this fraction of its cap, so the next stores fit without one
+RESCAN_EVERY = 256   # stores after which the cache directory is measured again, for what other processes stored
+
+# hits and misses of the lookups done in this process
+CACHE_STATS = {'hits': 0, 'misses': 0}
+# size of each cache directory this process stores to as last measured plus what it stored since, the bytes and the
+# stores since
+_cache_sizes = {}
+
+def image_hash(image_input):
+    """
+    Hashes the content of an image so renamed or copied files still hit the cache
+    INPUTS:
+    image_input (str or file-like): file path of the image or an open file (ex. a streamlit upload)
+    OUTPUTS:
+    digest (str): sha256 hex digest of the image bytes
+    """
+    h = hashlib.sha256()
+    if isinstance(image_input, (str, os.PathLike)):
+        with open(image_input, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        # the whole file whatever has read it so far (ex. the analysis), and the reader is left where it was
+        position = image_input.tell()
+        image_input.seek(0)
+        h.update(image_input.read())
+        image_input.seek(position)
+    return h.hexdigest()
+
+def cache_key(image_digest, params):
+    """
+    Combines the image hash with the analysis parameters, so changing any parameter invalidates old entries
+    INPUTS:
+    image_digest (str): hash of the image from image_hash
+    params (dict): the analysis parameters that the result depends on
+    OUTPUTS:
+    key (str): the cache key of the result
+    """
+    params_json = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(f'{image_digest}:{params_json}'.encode()).hexdigest()
+
+def _entry_paths(cache_dir, key):
+    return (os.path.join(cache_dir, f'{key}.metrics.pkl'),
+            os.path.join(cache_dir, f'{key}.labels.npz'))
+
+def lookup(cache_dir, key, need_labels=False):
+    """
+    Looks up a result in the cache and marks it as recently used
+    INPUTS:
+    cache_dir (str): directory of the cache
+    key (str): the cache key from cache_key
+    need_labels (bool): only count it as a hit if the part label image was stored too
+    OUTPUTS:
+    df (pandas DataFrame or None): the cached metrics, None on a miss
+    part_labels (numpy Array or None): the cached part label image if it was stored
+    """
+    import pandas as pd
+    metrics_path, labels_path = _entry_paths(cache_dir, key)
+    try:
+        df = pd.read_pickle(metrics_path)
+        part_labels = None
+        if os.path.exists(labels_path):
+            with np.load(labels_path) as data:
+                part_labels = data['labels']
+        elif need_labels:
+            raise FileNotFoundError(labels_path)
+        os.utime(metrics_path)
+    except (OSError, EOFError, ValueError):
+        # a missing or half evicted entry is just a miss
+        CACHE_STATS['misses'] += 1
+        return None, None
+    CACHE_STATS['hits'] += 1
+    return df, part_labels
+
+def _save_labels(path, part_labels):
+    # a file object keeps numpy from adding .npz to the temporary file name
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, labels=part_labels)
+
+def _atomic_write(path, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write(tmp_path)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)
+    return size
+
+def store(cache_dir, key, df, part_labels=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Stores a result in the cache and evicts the least recently used entries to keep it within max_bytes.
+    The size of the cache is kept as a running total, the directory is only listed (and the cache brought down
+    to EVICT_TO of max_bytes) when the total passes max_bytes, when this process stored (1 - EVICT_TO) *
+    max_bytes since it was last listed, or every RESCAN_EVERY stores. The running total only counts what this
+    process stores, so with several processes storing to the same cache (ex. the batch workers) it can grow
+    past max_bytes by up to (1 - EVICT_TO) * max_bytes for each of the other processes before they list it again
+    INPUTS:
+    cache_dir (str): directory of the cache
+    key (str): the cache key from cache_key
+    df (pandas DataFrame): the per-part metrics of the image
+    part_labels (numpy Array): optional part label image (0 background, i for the i-th part)
+    max_bytes (int): the size cap of the cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    metrics_path, labels_path = _entry_paths(cache_dir, key)
+    if part_labels is not None:
+        # write the labels first so a metrics file never points at missing labels
+        dtype = np.uint16 if part_labels.max() < 2**16 else np.int32
+        written = _atomic_write(labels_path, lambda p: _save_labels(p, part_labels.astype(dtype)))
+    else:
+        written = 0
+    written += _atomic_write(metrics_path, lambda p: df.to_pickle(p, compression=None))
+
+    total, stored, stores = _cache_sizes.get(cache_dir, (None, 0, 0))
+    if (total is None or total + written > max_bytes or stored + written > max_bytes * (1 - EVICT_TO)
+            or stores + 1 >= RESCAN_EVERY):
+        # an entry stored again is counted twice until then, which only makes the listing come sooner. Every listing
+        # brings the cache down to EVICT_TO of the cap, so the next one is again (1 - EVICT_TO) * max_bytes away
+        _cache_sizes[cache_dir] = (evict_lru(cache_dir, int(max_bytes * EVICT_TO)), 0, 0)
+    else:
+        _cache_sizes[cache_dir] = (total + written, stored + written, stores + 1)
+
+def evict_lru(cache_dir, max_bytes, target_bytes=None):
+    """
+    Deletes the least recently used entries until the cache is no bigger than max_bytes
+    INPUTS:
+    cache_dir (str): directory of the cache
+    max_bytes (int): the size cap of the cache
+    target_bytes (int): once over max_bytes, evict down to this size instead, defaults to max_bytes
+    OUTPUTS:
+    total (int): the size of the cache left in bytes
+    """
+    entries = {}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'):
+            continue
+        key = name.split('.', 1)[0]
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        size, last_used = entries.get(key, (0, 0.0))
+        if name.endswith('.metrics.pkl'):
+            last_used = st.st_mtime
+        entries[key] = (size + st.st_size, last_used)
+
+    total = sum(size for size, _ in entries.values())
+    if total <= max_bytes:
+        return total
+    target_bytes = max_bytes if target_bytes is None else target_bytes
+    for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+        if total <= target_bytes:
+            break
+        for path in _entry_paths(cache_dir, key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+    return total
@@ -1,36 +1,115 @@
+from collections import namedtuple
 from skimage.color import rgb2gray
 import numpy as np
-from skimage.morphology import dilation, disk, remove_small_holes, binary_closing
 from skimage.feature import canny
 from skimage.measure import label, regionprops
-from scipy.ndimage import binary_fill_holes
+from scipy.ndimage import find_objects
+from binary_morphology import dilate_disk, erode_disk, close_disk, fill_holes
+from instrumentation import record_value
 
-def threshold_parts(image):
+COARSE_PERCENTILE = 60  # grayscale percentile below which pixels may be part of a part
+HOLE_AREA = 3000        # holes in a part smaller than this are filled
+BG_PERCENTILE = 70      # non-part grayscale percentile above which pixels are background
+BG_CONFIDENCE_ALPHA = 0.01  # a sampled background threshold is within its error bound with 99% confidence
+
+def _segment_gray(gray, coarse_thresh, scale=1, canny_mode='constant'):
+    """
+    Thresholding and edge detection steps of threshold_parts on a grayscale image, with the sizes scaled for a downscaled image
+    INPUTS:
+    gray (numpy Array): the grayscale image (or a downscaled copy or crop of it)
+    coarse_thresh (float): the coarse threshold found on the full resolution grayscale image
+    scale (int): how many times smaller gray is than the full resolution image
+    canny_mode (str): how canny handles the borders of gray, 'nearest' avoids false edges at the border of a crop
+    OUTPUTS:
+    binary (bool numpy Array): the binary mask of the parts
+    """
+    # the boolean morphology of binary_morphology, identical to skimage's dilation, binary_closing and
+    # remove_small_holes with disk footprints and to scipy's binary_fill_holes
+    coarse_mask = dilate_disk(gray < coarse_thresh, max(1, round(6 / scale)))
+    edges = canny(gray, sigma=max(0.5, 2 / scale), mode=canny_mode)
+    edges &= coarse_mask
+
+    edges_dilated = dilate_disk(edges, max(1, round(2 / scale)))
+    # edges is no longer needed, the closing is written into it
+    closed = close_disk(edges_dilated, max(1, round(4 / scale)), out=edges)
+
+    closed &= coarse_mask
+    return fill_holes(closed, max_border_hole=max(1, HOLE_AREA // scale**2))
+
+def threshold_parts(image, downscale=1, min_area=3000):
     """
     Takes in an image and creates binary image to seperate parts out from the background using a coarse thresholding method as well as edge detection
+    With downscale > 1 the parts are first found on a downscaled image, and only the area around each part found is segmented again at full resolution
     INPUTS:
-    image ():
+    image (numpy Array): A numpy array representing the image to be analyzed
+    downscale (int): factor to downscale the image by for the coarse pass, 1 segments the whole image at full resolution
+    min_area (int): the minimum area of a part at full resolution, smaller blobs in the coarse pass are not refined
     OUTPUTS:
-    gray (): 
-    binary ():
+    gray (numpy Array): the grayscale version of the image
+    binary (bool numpy Array): the binary mask seperating the parts from the background
     coarse_thresh (int): The value [0, 1] that represents where the coarse thresh ended up
     """
     gray = rgb2gray(image)
-    coarse_thresh = np.percentile(gray, 60)
-    coarse_mask = gray < coarse_thresh
-    coarse_mask = dilation(coarse_mask, disk(6))
-    edges = canny(gray, sigma=2)
-    edges = edges & coarse_mask
-
-    edges_dilated = dilation(edges, disk(2))
-    closed = binary_closing(edges_dilated, disk(4))
+    coarse_thresh = np.percentile(gray, COARSE_PERCENTILE)
 
-    filled = binary_fill_holes(closed & coarse_mask)
-    filled = remove_small_holes(filled, area_threshold=3000)
+    if downscale <= 1:
+        binary = _segment_gray(gray, coarse_thresh)
+        return gray, binary, coarse_thresh
 
-    binary = filled
+    s = int(downscale)
+    boxes = coarse_part_boxes(block_mean(gray, s), coarse_thresh, s, gray.shape, min_area=min_area)
+    binary = np.zeros(gray.shape, dtype=bool)
+    for box in boxes:
+        binary[box] |= refine_part_box(gray[box], coarse_thresh)
     return gray, binary, coarse_thresh
 
+def block_mean(gray, scale):
+    """
+    Downscales a grayscale image by averaging scale x scale blocks, dropping the rows and columns that do not fill a block
+    INPUTS:
+    gray (numpy Array): the grayscale image, or a band of it whose height is a multiple of scale
+    scale (int): the downscale factor
+    OUTPUTS:
+    small (numpy Array): the downscaled image
+    """
+    h, w = gray.shape[0] // scale, gray.shape[1] // scale
+    return gray[:h * scale, :w * scale].reshape(h, scale, w, scale).mean(axis=(1, 3))
+
+def coarse_part_boxes(small, coarse_thresh, scale, shape, min_area=3000):
+    """
+    Finds the parts on a downscaled grayscale image, the coarse pass of threshold_parts
+    INPUTS:
+    small (numpy Array): the grayscale image downscaled with block_mean
+    coarse_thresh (float): the coarse threshold found on the full resolution grayscale image
+    scale (int): the downscale factor of small
+    shape (tuple): the shape of the full resolution image
+    min_area (int): the minimum area of a part at full resolution, smaller blobs are dropped
+    OUTPUTS:
+    boxes (list): the padded full resolution bounding box (tuple of slices) of each part found, to refine with refine_part_box
+    """
+    coarse_labels = label(_segment_gray(small, coarse_thresh, scale=scale))
+    pad = 16 + 2 * scale
+    boxes = []
+    for r in regionprops(coarse_labels):
+        if r.area * scale * scale < min_area / 2:
+            continue
+        minr, minc, maxr, maxc = r.bbox
+        r0, c0 = max(0, minr * scale - pad), max(0, minc * scale - pad)
+        r1, c1 = min(shape[0], maxr * scale + pad), min(shape[1], maxc * scale + pad)
+        boxes.append((slice(r0, r1), slice(c0, c1)))
+    return boxes
+
+def refine_part_box(gray, coarse_thresh):
+    """
+    Segments a coarse part again at full resolution within its padded bounding box
+    INPUTS:
+    gray (numpy Array): the full resolution grayscale image cropped to a box from coarse_part_boxes
+    coarse_thresh (float): the coarse threshold found on the full resolution grayscale image
+    OUTPUTS:
+    binary (bool numpy Array): the binary mask of the parts in the box, to OR into the mask of the whole image
+    """
+    return _segment_gray(gray, coarse_thresh, canny_mode='nearest')
+
 def extract_part_regions(binary_mask, min_area=5000):
     """
     Extracts regions for each part based on the binary mask and assigns them labels
@@ -65,30 +144,129 @@ def sort_regions_l2r(regions):
     sorted_regions = sorted(regions, key=lambda r: r.centroid[1])
     return sorted_regions
 
+# Compact representation of all the parts in an image.
+# labels: int32 array of the image, 0 is not a part and i is the i-th part from the left
+# slices: the bounding box (tuple of slices) of each part, in the same order
+PartLabels = namedtuple('PartLabels', ['labels', 'slices'])
+
 def regions_to_masks(labels, regions_sorted):
     """
-    Finalizes masking of the regions
+    Finalizes masking of the regions by relabeling them into a single label image numbered left to right
+    INPUTS:
+    labels (numpy Array): the label image from extract_part_regions
+    regions_sorted (list): the part regions sorted left to right
+    OUTPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    """
+    lut = np.zeros(labels.max() + 1, dtype=np.int32)
+    for i, r in enumerate(regions_sorted):
+        lut[r.label] = i + 1
+    return PartLabels(lut[labels], [r.slice for r in regions_sorted])
+
+def part_labels_to_masks(part_labels):
+    """
+    Rebuilds the part representation from a part label image, ex. one stored in the result cache
+    INPUTS:
+    part_labels (numpy Array): label image with 0 as background and i as the i-th part from the left
+    OUTPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    """
+    part_labels = part_labels.astype(np.int32, copy=False)
+    return PartLabels(part_labels, find_objects(part_labels))
+
+def iter_part_masks(part_masks):
+    """
+    Yields the mask of each part cropped to its bounding box, so work per part scales with the part size
+    INPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    OUTPUTS:
+    slc (tuple): the bounding box of the part to crop image arrays with
+    mask (bool numpy Array): the mask of the part within its bounding box
+    """
+    for i, slc in enumerate(part_masks.slices):
+        yield slc, part_masks.labels[slc] == i + 1
+
+def part_interior(mask, margin):
+    """
+    Finds the pixels of a part at least margin pixels inside its outline (the outline of its holes included),
+    away from the pixels that mix the part with the background
+    INPUTS:
+    mask (bool numpy Array): the mask of the part within its bounding box
+    margin (int): width in pixels of the band along the outline to leave out
+    OUTPUTS:
+    interior (bool numpy Array): the interior of the part, the same shape as mask
+    """
+    if margin <= 0:
+        return mask
+    # the bounding box edge is the part's outline too, erode_disk takes the pixels outside the array as part pixels
+    pad = margin + 1
+    return erode_disk(np.pad(mask, pad), margin)[pad:-pad, pad:-pad]
+
+def part_centroids(part_masks):
+    """
+    Finds the centroid of each part from its mask in its bounding box, for when the regions from segmentation are not at hand
+    INPUTS:
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    OUTPUTS:
+    centroids (list): the (row, column) centroid of each part, the same as regionprops gives
     """
-    return [(labels == r.label) for r in regions_sorted]
+    centroids = []
+    for slc, mask in iter_part_masks(part_masks):
+        rows, cols = np.nonzero(mask)
+        centroids.append((slc[0].start + rows.mean(), slc[1].start + cols.mean()))
+    return centroids
 
-def compute_background(gray, part_masks):
+def _background_sample_step(n_pixels, max_error):
     """
-    Determines masking of the background in order to be later normalized against
+    Picks the largest grid step whose sample still bounds the background percentile within max_error
+    INPUTS:
+    n_pixels (int): number of pixels in the image
+    max_error (float): allowed error of the percentile in percentile points, ex. 0.5 for the 69.5th to 70.5th percentile
+    OUTPUTS:
+    step (int): sample every step-th pixel in both directions
+    n_required (int): number of background pixels the sample needs
+    """
+    # Dvoretzky-Kiefer-Wolfowitz: with n samples the empirical CDF is within eps of the true one with 1 - alpha confidence
+    eps = max_error / 100
+    n_required = int(np.ceil(np.log(2 / BG_CONFIDENCE_ALPHA) / (2 * eps**2)))
+    return max(1, int(np.sqrt(n_pixels / n_required))), n_required
+
+def compute_background(gray, part_masks, max_error=None, sample_step=None):
+    """
+    Determines masking of the background in order to be later normalized against.
+    The threshold is a selection over the non-part pixels only, optionally on a strided grid of them.
     INPUTS:
     gray (numpy Array): the grayscale version of the image represented by a numpy array
-    part_masks (list): A list arrays that each represent the mask of the parts
+    part_masks (PartLabels): the part label image and the bounding box slice of each part
+    max_error (float): allowed error of the threshold in percentile points, the image is sampled on the
+                       coarsest grid that keeps it within that bound, None uses every pixel (exact)
+    sample_step (int): sample every sample_step-th pixel in both directions instead, overrides max_error
     OUTPUTS:
     bg_mask (array): an array representing the mask of the background
     """
-    parts_mask = np.zeros_like(gray, dtype=bool)
-    for pm in part_masks:
-        parts_mask |= pm
-    
-    gray_no_parts = gray.copy()
-    gray_no_parts[parts_mask] = np.nan
+    labels = part_masks.labels
+    n_required = 0
+    if sample_step is None:
+        sample_step = 1
+        if max_error is not None:
+            sample_step, n_required = _background_sample_step(gray.size, max_error)
+
+    while True:
+        grid = (slice(None, None, sample_step), slice(None, None, sample_step))
+        values = gray[grid][labels[grid] == 0]
+        # the parts cover part of the grid, so a coarse grid can fall short of the samples the bound needs
+        if values.size >= n_required or sample_step == 1:
+            break
+        sample_step = max(1, int(sample_step / np.sqrt(n_required / max(values.size, 1))))
+
+    bg_thresh = np.percentile(values, BG_PERCENTILE)
+    record_value('bg_thresh', float(bg_thresh))
+    record_value('bg_sample_step', sample_step)
 
-    bg_thresh = np.nanpercentile(gray_no_parts, 70)
-    print(f'bg thresh: {bg_thresh}')
-    bg_mask = gray_no_parts > bg_thresh
+    # same mask as thresholding the image with the parts set to NaN: parts are never background
+    bg_mask = gray > bg_thresh
+    for i, slc in enumerate(part_masks.slices):
+        if slc is not None:
+            bg_mask[slc][labels[slc] == i + 1] = False
 
     return bg_mask
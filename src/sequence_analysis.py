@@ -0,0 +1,169 @@
+"""
+Analysis of bursts and exposure brackets of the same tray, where the parts do not move between frames.
+
+The first frame is segmented as usual and becomes the key frame. Every later frame is first compared with the key
+frame on a low resolution copy: phase correlation estimates the shift of the tray and the correlation of the two
+copies tells whether the scene is still the same (a part added, removed or turned lowers it, a change of exposure
+does not). While a frame is aligned, the key frame's part labels and background mask are reused and only the
+normalization (or, for raw metrics, the lightness of the background), Lab conversion and metrics run. A frame that
+moved is segmented again and becomes the new key frame.
+
+    python sequence_analysis.py burst_*.jpg -o burst_metrics.csv
+"""
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+from skimage.color import rgb2gray
+from skimage.registration import phase_cross_correlation
+from utils import load_image, build_results_table
+from segmentation import threshold_parts, extract_part_regions, sort_regions_l2r, regions_to_masks, compute_background
+from color_processing import (convert_to_lab, linear_normalize_from_bg, sampled_background_mean, background_lightness,
+                              gather_part_pixels, gather_part_interiors, compute_metrics_batched, BG_LEVEL_STEP)
+from instrumentation import stage, record_value
+
+ALIGN_SIZE = 512        # longest side in pixels of the low resolution copies the alignment is checked on
+ALIGN_UPSAMPLE = 10     # the shift is estimated to 1/ALIGN_UPSAMPLE of a low resolution pixel
+MAX_SHIFT = 2.0         # largest shift from the key frame in full resolution pixels that still reuses its segmentation
+MIN_CORRELATION = 0.97  # lowest correlation with the key frame that still reuses its segmentation
+
+def alignment_thumbnail(image):
+    """
+    Makes the low resolution copy of a frame the alignment is checked on
+    INPUTS:
+    image (numpy Array): the frame, as given by load_image in any pipeline mode
+    OUTPUTS:
+    thumb (numpy Array): the grayscale frame sampled every step-th pixel, scaled to zero mean and unit variance
+                         so that a change of exposure between frames does not count as a change of the scene
+    step (int): the sampling step, the size of a low resolution pixel in full resolution pixels
+    """
+    step = max(1, -(-max(image.shape[:2]) // ALIGN_SIZE))
+    thumb = rgb2gray(image[::step, ::step])
+    return (thumb - thumb.mean()) / max(thumb.std(), 1e-12), step
+
+def check_alignment(key_thumb, key_spectrum, thumb, step):
+    """
+    Measures how far a frame is from the key frame
+    INPUTS:
+    key_thumb (numpy Array): alignment_thumbnail of the key frame
+    key_spectrum (numpy Array): np.fft.fft2 of key_thumb, computed once per key frame
+    thumb (numpy Array): alignment_thumbnail of the frame
+    step (int): the sampling step of the thumbnails
+    OUTPUTS:
+    shift (float): estimated shift of the frame from the key frame in full resolution pixels
+    correlation (float): correlation of the two thumbnails, 1 for the same scene
+    """
+    shift, _, _ = phase_cross_correlation(key_spectrum, np.fft.fft2(thumb), upsample_factor=ALIGN_UPSAMPLE,
+                                          space='fourier', normalization=None)
+    correlation = float(np.mean(key_thumb * thumb))
+    return float(np.hypot(*shift)) * step, correlation
+
+def _segment(img, downscale, min_area, background=True):
+    """
+    The segmentation of a key frame: the part labels and the background mask (None when background is False)
+    """
+    with stage('threshold'):
+        gray, binary, _ = threshold_parts(img, downscale=downscale, min_area=min_area)
+    with stage('regions'):
+        labels, regions = extract_part_regions(binary, min_area=min_area)
+        regions_sorted = sort_regions_l2r(regions)
+    with stage('masks'):
+        part_masks = regions_to_masks(labels, regions_sorted)
+    bg_mask = None
+    if background:
+        with stage('background'):
+            bg_mask = compute_background(gray, part_masks)
+    return part_masks, bg_mask
+
+def _frame_metrics(img, part_masks, bg_mask, interior, mode, group, normalized=True):
+    """
+    The metrics of a frame with its part labels, background mask and part interiors known, as analyze_image_core
+    computes them (or as analyze_image_core_batch does when not normalized, with the background lightness of a
+    sample of the frame)
+    """
+    bg_L = 100
+    with stage('normalize'):
+        part_pixels, part_sizes = gather_part_pixels(img, part_masks)
+        if normalized:
+            part_pixels = linear_normalize_from_bg(img, bg_mask, pixels=part_pixels, mode=mode)
+        else:
+            grid = (slice(None, None, BG_LEVEL_STEP), slice(None, None, BG_LEVEL_STEP))
+            sample = img[grid]
+            bg_L = background_lightness(sampled_background_mean(sample, rgb2gray(sample), part_masks.labels[grid] > 0))
+    with stage('lab'):
+        L, a, b = convert_to_lab(part_pixels, mode=mode)
+    with stage('metrics'):
+        metrics = compute_metrics_batched(L, a, b, part_sizes, bg_L=bg_L, interior=interior)
+    with stage('table'):
+        return build_results_table(*metrics, group=group)
+
+def analyze_sequence(frames, normalized=True, mode='float64', downscale=1, min_area=3000,
+                     max_shift=MAX_SHIFT, min_correlation=MIN_CORRELATION):
+    """
+    Analyzes the frames of a burst or exposure bracket, segmenting only the frames where the tray moved
+    INPUTS:
+    frames (iterable): file paths of the frames, or frames already decoded with imread, in capture order
+    normalized (bool): metrics on the background normalized image like analyze_image_core, or on the raw image like
+                       analyze_image_core_batch (a sample of the background then only sets the white rust L* range)
+    mode (str): color pipeline mode, 'float64' (reference), 'float32' or 'lut' (see PIPELINE_MODES in utils)
+    downscale (int): downscale factor for the coarse segmentation pass, 1 segments at full resolution
+    min_area (int): the minimum area of a part in pixels
+    max_shift (float): largest shift from the key frame in pixels at which a frame reuses its segmentation
+    min_correlation (float): lowest correlation with the key frame at which a frame reuses its segmentation
+    OUTPUTS:
+    df (pandas DataFrame): yields the metrics of each frame in turn, with the frame's file name (or index) as group.
+                           df.attrs holds 'key_frame' (index of the frame whose segmentation was used),
+                           'segmented' (whether the frame was segmented itself), 'shift' and 'correlation'
+    """
+    key = None
+    for index, frame in enumerate(frames):
+        group = os.path.splitext(os.path.basename(frame))[0] if isinstance(frame, str) else str(index)
+        with stage('load'):
+            img = load_image(frame, mode=mode)
+        with stage('align'):
+            thumb, step = alignment_thumbnail(img)
+            shift, correlation = np.inf, 0.0
+            if key is not None and key['shape'] == img.shape:
+                shift, correlation = check_alignment(key['thumb'], key['spectrum'], thumb, step)
+            record_value('align_shift', shift)
+            record_value('align_correlation', correlation)
+        segmented = shift > max_shift or correlation < min_correlation
+        if segmented:
+            part_masks, bg_mask = _segment(img, downscale, min_area, background=normalized)
+            key = {'index': index, 'shape': img.shape, 'thumb': thumb, 'spectrum': np.fft.fft2(thumb),
+                   'part_masks': part_masks, 'bg_mask': bg_mask, 'interior': gather_part_interiors(part_masks)}
+        df = _frame_metrics(img, key['part_masks'], key['bg_mask'], key['interior'], mode, group, normalized=normalized)
+        df.attrs.update(key_frame=key['index'], segmented=segmented, shift=shift, correlation=correlation)
+        yield df
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze a burst or exposure bracket of the same tray, segmenting it once.')
+    parser.add_argument('frames', nargs='+', help='image files of the frames, in capture order')
+    parser.add_argument('-o', '--output', default='sequence_metrics.csv', help='CSV file to write the metrics of every frame to')
+    parser.add_argument('--mode', default='float64', help="color pipeline mode, 'float64', 'float32' or 'lut'")
+    parser.add_argument('--downscale', type=int, default=1)
+    parser.add_argument('--raw', action='store_true', help='metrics on the raw image, like the batch analysis')
+    parser.add_argument('--max-shift', type=float, default=MAX_SHIFT,
+                        help='largest shift in pixels at which a frame reuses the segmentation of the key frame')
+    parser.add_argument('--min-correlation', type=float, default=MIN_CORRELATION,
+                        help='lowest correlation with the key frame at which a frame reuses its segmentation')
+    args = parser.parse_args(argv)
+
+    tables = []
+    sequence = analyze_sequence(args.frames, normalized=not args.raw, mode=args.mode, downscale=args.downscale,
+                                max_shift=args.max_shift, min_correlation=args.min_correlation)
+    for frame, df in zip(args.frames, sequence):
+        name = os.path.basename(frame)
+        if df.attrs['segmented']:
+            print(f"{name}: segmented, {len(df)} parts")
+        else:
+            print(f"{name}: reused frame {df.attrs['key_frame']} (shift {df.attrs['shift']:.2f} px, "
+                  f"correlation {df.attrs['correlation']:.3f}), {len(df)} parts")
+        tables.append(df)
+    pd.concat(tables, ignore_index=True).to_csv(args.output, index=False)
+    print(f'Metrics saved to {args.output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Sharded batch runs over several machines, and merging their outputs.
+
+Every machine lists the same image tree and analyzes only its own shard, picked by a stable hash of each image's
+relative path (multi_file.shard_of), so the machines split the work without coordinating. Each writes to its own
+output directory, and merge combines them:
+
+    python shards.py run /archive out/shard-0 --shard 0/4 --workers 8      # on each machine, shards 0 to 3
+    python shards.py merge out/shard-0 out/shard-1 out/shard-2 out/shard-3 -o out/merged --images /archive
+
+The merge keeps one analysis per image, reports the images that failed in every shard and, given the image tree,
+the images no shard analyzed. A shard can be run again with --resume to retry or finish it before merging.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import pandas as pd
+# parse_shard lives with list_images, which checks the shards it is given, and is imported from here too
+from multi_file import MANIFEST_NAME, analyze_images_in_directory, list_images, load_manifest, parse_shard
+from columnar_output import COLUMNAR_FORMATS, DATASET_DIR, check_columnar_options, read_metrics_dataset, write_dataset_files
+from utils import IMAGE_COLUMN_TYPES
+
+REPORT_NAME = 'merge_report.json'
+
+def _confirmed_rows(shard_dir, manifest):
+    """
+    The rows of a shard's combined CSV that its manifest confirms, with only the latest analysis of each image
+    """
+    combined_path = os.path.join(shard_dir, 'combined_metrics.csv')
+    if not os.path.exists(combined_path) or not manifest:
+        return pd.DataFrame(columns=['group'])
+    # rows past the last manifest record belong to an image that was still being written when the run stopped
+    offset = max(r['csv_offset'] for r in manifest.values())
+    with open(combined_path, 'rb') as f:
+        data = f.read(offset)
+    if not data:
+        return pd.DataFrame(columns=['group'])
+    rows = pd.read_csv(io.BytesIO(data), dtype={'group': str})
+    # an image analyzed again after it changed has its rows appended again, possibly right after its previous rows:
+    # every analysis starts at part 1, and the last one of each image is the latest
+    analysis = ((rows['group'] != rows['group'].shift()) | (rows['Part #'] == 1)).cumsum()
+    return rows[analysis == analysis.groupby(rows['group']).transform('max')]
+
+def _pick(records):
+    """
+    Picks the analysis of an image to keep from its records in several shards: a successful one over a failed one,
+    then the one of the newest version of the file, then the shard given last
+    """
+    return max(records, key=lambda r: (r[1]['status'] == 'ok', r[1]['identity'][1], r[0]))
+
+def merge_shards(shard_dirs, output_directory, image_directory=None, recursive=True, columnar=None, partition_by=None):
+    """
+    Combines the outputs of shard runs into one output directory, keeping one analysis per image
+    INPUTS:
+    shard_dirs (list): output directories of the shard runs
+    output_directory (str): directory to write the merged combined_metrics.csv, manifest and report to
+    image_directory (str): the image tree the shards were run on, to report the images no shard analyzed
+    recursive (bool): whether the shards were run on the subdirectories of image_directory too
+    columnar (str): also merge the shards' Parquet or Arrow datasets, 'parquet' or 'arrow'
+    partition_by (str): partitioning of the merged dataset, None, 'date' or 'lot'
+    OUTPUTS:
+    report (dict): number of images merged and of images found in several shards, and the lists of failed
+                   and missing images (also written to merge_report.json)
+    """
+    if columnar is not None:
+        check_columnar_options(columnar, partition_by)
+    if os.path.exists(os.path.join(output_directory, MANIFEST_NAME)):
+        raise ValueError(f'{output_directory} already has a manifest, merge into a new directory')
+    os.makedirs(output_directory, exist_ok=True)
+
+    manifests = [load_manifest(d) for d in shard_dirs]
+    records = {}
+    for i, manifest in enumerate(manifests):
+        for filename, record in manifest.items():
+            records.setdefault(filename, []).append((i, record))
+    chosen = {filename: _pick(found) for filename, found in records.items()}
+    duplicates = sorted(f for f, found in records.items() if len(found) > 1)
+    failed = sorted(f for f, (_, record) in chosen.items() if record['status'] != 'ok')
+
+    frames = []
+    for i, (shard_dir, manifest) in enumerate(zip(shard_dirs, manifests)):
+        groups = {os.path.splitext(f)[0] for f, (shard, record) in chosen.items() if shard == i and record['status'] == 'ok'}
+        rows = _confirmed_rows(shard_dir, manifest)
+        frames.append(rows[rows['group'].isin(groups)])
+    merged = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if len(merged):
+        merged = merged.sort_values(['group', 'Part #'], kind='stable')
+    combined_path = os.path.join(output_directory, 'combined_metrics.csv')
+    merged.to_csv(combined_path, index=False)
+
+    # the merged directory can be resumed like a single run: every chosen record points past all the rows
+    offset = os.path.getsize(combined_path)
+    with open(os.path.join(output_directory, MANIFEST_NAME), 'w') as f:
+        for filename in sorted(chosen):
+            record = dict(chosen[filename][1], csv_offset=offset)
+            f.write(json.dumps(record) + '\n')
+
+    if columnar is not None:
+        _merge_datasets(shard_dirs, chosen, os.path.join(output_directory, DATASET_DIR), columnar, partition_by)
+
+    missing = []
+    if image_directory is not None:
+        missing = [f for f in list_images(image_directory, recursive=recursive, exclude=output_directory) if f not in chosen]
+
+    report = {
+        'shards': len(shard_dirs),
+        'images': len(chosen) - len(failed),
+        'rows': len(merged),
+        'duplicates': len(duplicates),
+        'failed': failed,
+        'missing': missing,
+    }
+    with open(os.path.join(output_directory, REPORT_NAME), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Merged {report['images']} images ({report['rows']} parts) from {len(shard_dirs)} shards, "
+          f"{len(duplicates)} images were in more than one shard")
+    if failed:
+        print(f"{len(failed)} images failed: {', '.join(failed[:20])}{' ...' if len(failed) > 20 else ''}")
+    if image_directory is not None:
+        print(f"{len(missing)} images were not analyzed by any shard"
+              f"{': ' + ', '.join(missing[:20]) if missing else ''}{' ...' if len(missing) > 20 else ''}")
+    return report
+
+def _merge_datasets(shard_dirs, chosen, dataset_dir, fmt, partition_by):
+    """
+    Writes the chosen analysis of every image from the shards' columnar datasets into one dataset
+    """
+    # an image is in a dataset under its group and the modification time of the file it was analyzed from
+    keep = {(os.path.splitext(f)[0], pd.Timestamp(record['identity'][1], unit='ns', tz='UTC'), shard)
+            for f, (shard, record) in chosen.items() if record['status'] == 'ok'}
+    frames = []
+    for i, shard_dir in enumerate(shard_dirs):
+        shard_dataset = os.path.join(shard_dir, DATASET_DIR)
+        if not os.path.isdir(shard_dataset):
+            print(f"WARNING: {shard_dir} has no {DATASET_DIR}, its images are left out of the merged dataset")
+            continue
+        df = read_metrics_dataset(shard_dataset, fmt)
+        # the partition columns come back from the directory names, the files hold the build_results_table schema
+        df = df.drop(columns=['date'], errors='ignore').astype(IMAGE_COLUMN_TYPES)
+        chosen_rows = [(g, t, i) in keep for g, t in zip(df['group'], df['timestamp'])]
+        frames.append(df[chosen_rows].drop_duplicates(['group', 'timestamp', 'Part #']))
+    write_dataset_files(frames, dataset_dir, fmt, partition_by)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run one shard of a batch, or merge the outputs of the shards.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='analyze one shard of an image tree')
+    run.add_argument('images', help='image directory, the same on every machine')
+    run.add_argument('output', help='output directory of this shard')
+    run.add_argument('--shard', required=True, help='index/count, ex. 0/4 for the first of four shards')
+    run.add_argument('--flat', action='store_true', help='only the images directly in the image directory')
+    run.add_argument('--workers', type=int, default=1)
+    run.add_argument('--mode', default='float64', help="color pipeline mode, 'float64', 'float32' or 'lut'")
+    run.add_argument('--downscale', type=int, default=1)
+    run.add_argument('--cache-dir', help='result cache directory')
+    run.add_argument('--resume', action='store_true', help='skip the images the shard already processed')
+    run.add_argument('--columnar', choices=COLUMNAR_FORMATS, help='also write a Parquet or Arrow dataset')
+    run.add_argument('--no-per-image-csv', action='store_true', help='only write the combined CSV')
+
+    merge = commands.add_parser('merge', help='combine the output directories of the shards')
+    merge.add_argument('shards', nargs='+', help='output directories of the shards')
+    merge.add_argument('-o', '--output', required=True, help='directory to write the merged outputs to')
+    merge.add_argument('--images', help='image directory, to report the images no shard analyzed')
+    merge.add_argument('--flat', action='store_true', help='the shards were run without subdirectories')
+    merge.add_argument('--columnar', choices=COLUMNAR_FORMATS, help='also merge the shards\' Parquet or Arrow datasets')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        failed = analyze_images_in_directory(
+            args.images, args.output, workers=args.workers, mode=args.mode, downscale=args.downscale,
+            cache_dir=args.cache_dir, resume=args.resume, columnar=args.columnar,
+            per_image_csv=not args.no_per_image_csv, recursive=not args.flat, shard=parse_shard(args.shard)
+        )
+        return 1 if failed else 0
+    report = merge_shards(args.shards, args.output, image_directory=args.images, recursive=not args.flat,
+                          columnar=args.columnar)
+    return 1 if report['failed'] or report['missing'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import os
 from analysis_core import analyze_image_core
+from visualization import PREVIEW_SIZE
 
 def main():
     path = input('Enter image path: ').strip()
@@ -7,10 +8,13 @@ def main():
 
     os.makedirs(output_dir, exist_ok=True)
 
-    df, fig, annotated_buf = analyze_image_core(
+    df, fig, _ = analyze_image_core(
         image_input=path,
         output_dir=output_dir,
-        return_fig=True
+        return_fig=True,
+        annotate=False,
+        preview=PREVIEW_SIZE,
+        pyplot=True
     )
 
     csv_path = os.path.join(output_dir, 'metrics.csv')
@@ -1,35 +1,77 @@
+import os
+import time
 import streamlit as st
-from analysis_core import analyze_image_core
+from analysis_jobs import submit_analysis, job_status
+
+POLL_INTERVAL = 0.5  # seconds between refreshes while analyses are running
+
+def upload_id(index, uploaded):
+    """
+    Identifies an upload across reruns: two uploads can have the same file name (ex. from different folders)
+    """
+    # file_id is unique per upload, older streamlit versions without it fall back to the position in the list
+    return getattr(uploaded, 'file_id', None) or f'{index}-{uploaded.name}'
 
 st.set_page_config(page_title='Fastener Color Analysis', layout='wide')
 
 st.title('Fastener Color Analysis')
 
-uploaded = st.file_uploader('Upload an Image', type=['jpg', 'jpeg', 'png'])
+uploads = st.file_uploader('Upload Images', type=['jpg', 'jpeg', 'png'], accept_multiple_files=True)
+
+# keys of the analyses started from this session, they survive the reruns of download clicks
+if 'jobs' not in st.session_state:
+    st.session_state['jobs'] = {}
+jobs = st.session_state['jobs']
 
-if uploaded:
-    st.image(uploaded, caption='Uploaded Image', use_column_width=True)
+if uploads:
     if st.button('Run Analysis'):
-        with st.spinner('Analyzing Image...'):
-            df, fig, annotated_buf = analyze_image_core(
-                image_input = uploaded,
-                output_dir = None,
-                return_fig = True
-            )
+        for index, uploaded in enumerate(uploads):
+            # analyses run in the background and are cached on the uploaded bytes, so the same image is analyzed once
+            jobs[upload_id(index, uploaded)] = submit_analysis(uploaded.getvalue(), uploaded.name)
+
+    running = False
+    for index, uploaded in enumerate(uploads):
+        st.header(uploaded.name)
+        upload = upload_id(index, uploaded)
+        key = jobs.get(upload)
+        status = job_status(key) if key is not None else None
+        if status is None:
+            st.image(uploaded, caption='Uploaded Image', use_column_width=True)
+            continue
+        if not status['done']:
+            running = True
+            st.progress(status['progress'])
+            st.caption(f"Analyzing: {status['stage']}")
+            continue
+        if status['error'] is not None:
+            st.error(f"Analysis failed: {status['error']}")
+            continue
+
+        result = status['result']
+        df = result['df']
+        base = os.path.splitext(uploaded.name)[0]
         st.subheader('Processing Visualization')
-        st.pyplot(fig)
+        st.image(result['figure_png'], use_column_width=True)
         st.subheader('Per-Part Metrics')
         st.dataframe(df)
         st.download_button(
             'Download Metrics CSV',
             df.to_csv(index=False).encode(),
-            'metrics.csv',
-            'text/csv'
+            f'{base}_metrics.csv',
+            'text/csv',
+            key=f'{upload}-csv'
         )
 
         st.download_button(
             'Download Visualization',
-            annotated_buf,
-            'visualization.jpg',
-            'image/jpeg'
+            result['annotated_jpg'],
+            f'{base}_visualization.jpg',
+            'image/jpeg',
+            key=f'{upload}-jpg'
         )
+
+    if running:
+        # refresh until every analysis is done, the script thread is never blocked by the analysis itself
+        time.sleep(POLL_INTERVAL)
+        rerun = getattr(st, 'rerun', None) or st.experimental_rerun
+        rerun()
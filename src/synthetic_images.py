@@ -0,0 +1,68 @@
+import numpy as np
+
+def make_lightbox_image(megapixels=2, n_parts=5, seed=0, aspect=1.5):
+    """
+    Generates a synthetic lightbox photo: dark fasteners (hex nuts and bolts) with specular highlights
+    on a near-white, slightly vignetted background. Used to benchmark the pipeline at any resolution.
+    INPUTS:
+    megapixels (float): size of the image in millions of pixels
+    n_parts (int): number of parts to place, in a grid kept clear of the bottom edge
+    seed (int): seed of the random shading, highlights and noise, the same seed gives the same image
+    aspect (float): width / height of the image
+    OUTPUTS:
+    image (uint8 numpy Array): the RGB image
+    """
+    rng = np.random.default_rng(seed)
+    h = int(round(np.sqrt(megapixels * 1e6 / aspect)))
+    w = int(round(h * aspect))
+
+    # background: near white with a soft vignette and sensor noise
+    yy = np.linspace(-1, 1, h, dtype=np.float32)[:, None]
+    xx = np.linspace(-1, 1, w, dtype=np.float32)[None, :]
+    bg = 242 - 14 * (xx**2 + yy**2)
+    image = np.repeat(bg[..., None], 3, axis=2)
+    image *= np.array([1.0, 0.995, 0.985], dtype=np.float32)
+
+    cols = int(np.ceil(np.sqrt(n_parts * aspect)))
+    rows = int(np.ceil(n_parts / cols))
+    cell = min(w / cols, 0.85 * h / rows)
+    radius = 0.32 * cell
+    x0 = (w - cols * cell) / 2
+    y0 = 0.05 * h
+
+    for i in range(n_parts):
+        r, c = divmod(i, cols)
+        cy = y0 + (r + 0.5) * cell + rng.uniform(-0.05, 0.05) * cell
+        cx = x0 + (c + 0.5) * cell + rng.uniform(-0.05, 0.05) * cell
+        minr, maxr = int(cy - radius) - 2, int(cy + radius) + 3
+        minc, maxc = int(cx - radius) - 2, int(cx + radius) + 3
+        py, px = np.mgrid[minr:maxr, minc:maxc].astype(np.float32)
+        dy, dx = (py - cy) / radius, (px - cx) / radius
+
+        if i % 2 == 0:
+            # hex nut seen from above
+            angle = rng.uniform(0, np.pi / 3)
+            u = np.abs(dx * np.cos(angle) + dy * np.sin(angle))
+            v = np.abs(-dx * np.sin(angle) + dy * np.cos(angle))
+            mask = np.maximum(u * np.sqrt(3) / 2 + v / 2, v) <= 0.9
+        else:
+            # bolt lying down: shank and head
+            mask = ((np.abs(dx) <= 0.95) & (np.abs(dy) <= 0.22)) | ((np.abs(dx + 0.75) <= 0.2) & (np.abs(dy) <= 0.45))
+
+        base = rng.uniform(25, 45)
+        tint = rng.normal(0, 1.5, size=3)
+        shade = base * (1 - 0.25 * dy) + rng.normal(0, 1.5, size=mask.shape)
+        part = shade[..., None] + tint
+
+        # specular highlights: a few bright elongated blobs on the part
+        for _ in range(rng.integers(2, 5)):
+            hy, hx = rng.uniform(-0.4, 0.4, size=2)
+            sy, sx = rng.uniform(0.03, 0.08), rng.uniform(0.1, 0.3)
+            blob = np.exp(-((dy - hy)**2 / (2 * sy**2) + (dx - hx)**2 / (2 * sx**2)))
+            part += (blob * rng.uniform(120, 200))[..., None]
+
+        region = image[minr:maxr, minc:maxc]
+        region[mask] = part[mask]
+
+    image += rng.normal(0, 1.5, size=(h, w, 1)).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
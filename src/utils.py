@@ -1,17 +1,38 @@
-from skimage.io import imread
 import numpy as np
-import pandas as pd
 
-def load_image(filename):
+# Color pipeline modes. 'float64' is the reference. 'float32' halves the memory of every image array and
+# 'lut' keeps the image as 8-bit and replaces the sRGB power curves with lookup tables.
+# Maximum deviation from float64 measured on the sample image (and 0.8x / 1.15x brightness copies of it):
+#   float32: Blackness 0.014, Color Shift 0.002
+#   lut:     Blackness 0.16,  Color Shift 0.05 (the normalized image is quantized back to 8 bits)
+# analyze_image_core_batch does not normalize, so both modes match it within 1e-4 there.
+PIPELINE_MODES = ('float64', 'float32', 'lut')
+
+def load_image(filename, mode='float64'):
     """
     Load an image file and return it as a numpy array
     INPUTS:
-    filename (string): the path to the image file
+    filename (string or numpy Array): the path to the image file, or an image already decoded with imread
+    mode (string): the pipeline mode, 'float64' (reference), 'float32', or 'lut' to keep the 8-bit values for the lookup table pipeline
 
     OUTPUTS:
     image (numpy array): the loaded image as a numpy array
     """
-    image = imread(filename).astype(float) / 255.0
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f'Unknown pipeline mode {mode!r}, expected one of {PIPELINE_MODES}')
+    if isinstance(filename, np.ndarray):
+        image = filename
+    else:
+        # skimage.io and its plugins load on the first file read, callers passing arrays never import them
+        from skimage.io import imread
+        image = imread(filename)
+    if mode == 'lut':
+        if image.dtype != np.uint8:
+            raise ValueError('The lut pipeline mode requires an 8-bit image')
+        return image
+    if mode == 'float32':
+        return image.astype(np.float32) / np.float32(255.0)
+    image = image.astype(float) / 255.0
     return image
 
 def srgb_to_linear(image):
@@ -40,7 +61,19 @@ def linear_to_srgb(image):
                  1.055 * image ** (1/2.4) - 0.055)
     return srgb_image
 
-def build_results_table(blackness, color_shift, a_shift, b_shift, gloss):
+# srgb_to_linear of every 8-bit value, so 8-bit images are linearized with a lookup instead of a power
+SRGB_TO_LINEAR_LUT = srgb_to_linear(np.arange(256) / 255.0)
+
+# types of the image columns build_results_table can add, so every output (and every image) has the same schema
+IMAGE_COLUMN_TYPES = {
+    'group': 'string',
+    'image_hash': 'string',
+    'timestamp': 'datetime64[ns, UTC]',
+    'lot': 'string',
+}
+
+def build_results_table(blackness, color_shift, a_shift, b_shift, gloss, red_rust=None, white_rust=None,
+                        group=None, image_hash=None, timestamp=None, lot=None):
     """
     Builds a pandas DataFrame that contains the response variables of analysis
     INPUTS:
@@ -49,9 +82,17 @@ def build_results_table(blackness, color_shift, a_shift, b_shift, gloss):
     a_shift (list): A list of calculated median a values for each part
     b_shift (list): A list of calculated median b values for eahc part
     gloss (list): A list of calculated gloss score values for each part
+    red_rust (list): optional fraction of each part that is red rust, from compute_metrics
+    white_rust (list): optional fraction of each part that is white rust, from compute_metrics
+    group (str): optional name of the image the parts are from
+    image_hash (str): optional content hash of the image (see result_cache.image_hash)
+    timestamp (pandas Timestamp): optional time the image was taken
+    lot (str): optional lot number of the parts
     OUTPUTS:
-    df (pandas DataFrame): a dataframe consisting of all the analyzed parts and their respective response variables
+    df (pandas DataFrame): a dataframe consisting of all the analyzed parts and their respective response variables,
+                           followed by the typed image columns that were given
     """
+    import pandas as pd
     df = pd.DataFrame({
         'Part #': list(range(1, len(blackness) + 1)),
         'Blackness': blackness,
@@ -60,4 +101,12 @@ def build_results_table(blackness, color_shift, a_shift, b_shift, gloss):
         'Median a*': a_shift,
         'Median b*': b_shift
     })
-    return df
\ No newline at end of file
+    if red_rust is not None:
+        df['Red Rust Fraction'] = red_rust
+    if white_rust is not None:
+        df['White Rust Fraction'] = white_rust
+    image_columns = {'group': group, 'image_hash': image_hash, 'timestamp': timestamp, 'lot': lot}
+    for name, value in image_columns.items():
+        if value is not None:
+            df[name] = pd.Series([value] * len(df), dtype=IMAGE_COLUMN_TYPES[name])
+    return df
@@ -1,11 +1,26 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from skimage.measure import regionprops
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from segmentation import part_centroids
+
+# the numbered parts image is drawn without matplotlib, it is imported here for existing callers
+from annotation import save_numbered_parts_with_metrics
+
+PREVIEW_SIZE = 1600  # longest side in pixels of the images drawn in interactive (preview) figures
 
 def save_plot(fig, save_path):
     if save_path:
         fig.savefig(save_path, dpi=300, bbox_inches='tight')
 
+def _preview_step(shape, preview):
+    """
+    Stride that brings an image of the given shape down to at most preview pixels on its longest side,
+    1 for full resolution (preview None)
+    """
+    if preview is None:
+        return 1
+    return max(1, int(np.ceil(max(shape[:2]) / preview)))
+
 def show_results(
         image,
         gray,
@@ -14,47 +29,59 @@ def show_results(
         part_masks,
         bg_mask,
         save_path=None,
-        return_fig=False
+        return_fig=False,
+        centroids=None,
+        preview=None,
+        pyplot=False
 ):
-    combined = np.zeros_like(part_masks[0], dtype=int)
-    for i, pm in enumerate(part_masks):
-        combined[pm] = i + 1
-    regions = regionprops(combined)
-    del combined  # prevent regionprops memory retention
-
-    fig, axes = plt.subplots(2, 3, figsize=(18, 10))
-    ax0, ax1, ax2, ax3, ax4, ax5 = axes.ravel()
+    """
+    Draws the 2x3 figure of the analysis steps: original, histogram, binary mask, parts, background and numbered parts
+    INPUTS:
+    centroids (list): the (row, column) centroid of each part, ex. from the segmentation regions, found from part_masks if None
+    preview (int): draw the images at most this many pixels on their longest side (ex. PREVIEW_SIZE), None for full resolution
+    pyplot (bool): make the figure with pyplot so that it can be shown in a window, otherwise it is a Figure on its
+                   own Agg canvas that pyplot does not know about, safe to draw in any thread and freed with it
+    """
+    if centroids is None:
+        centroids = part_centroids(part_masks)
+    step = _preview_step(image.shape, preview)
+    view = (slice(None, None, step), slice(None, None, step))
+
+    if pyplot:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(18, 10))
+    else:
+        fig = Figure(figsize=(18, 10))
+        FigureCanvasAgg(fig)
+    ax0, ax1, ax2, ax3, ax4, ax5 = fig.subplots(2, 3).ravel()
 
-    ax0.imshow(image)
+    ax0.imshow(image[view])
     ax0.set_title("Original")
     ax0.axis('off')
 
-    ax1.hist(gray.ravel(), bins=256)
+    ax1.hist(gray[view].ravel(), bins=256)
     ax1.set_title('Histogram')
 
-    ax2.imshow(binary, cmap='gray')
+    ax2.imshow(binary[view], cmap='gray')
     ax2.set_title('Binary Part Mask')
     ax2.axis('off')  # FIXED
 
-    mask_combined = np.zeros(part_masks[0].shape, dtype=bool)
-    for pm in part_masks:
-        mask_combined |= pm
-    ax3.imshow(image)
+    mask_combined = part_masks.labels[view] > 0
+    ax3.imshow(image[view])
     ax3.imshow(mask_combined, cmap='jet', alpha=0.4)
     ax3.set_title('Parts Overlay')
     ax3.axis('off')
     del mask_combined
 
-    ax4.imshow(image)
-    ax4.imshow(bg_mask, cmap='Greens', alpha=0.4)
+    ax4.imshow(image[view])
+    ax4.imshow(bg_mask[view], cmap='Greens', alpha=0.4)
     ax4.set_title('Background (green)')
     ax4.axis('off')
 
-    ax5.imshow(image)
-    for i, region in enumerate(regions):
-        y, x = region.centroid
+    ax5.imshow(image[view])
+    for i, (y, x) in enumerate(centroids):
         ax5.text(
-            x, y, f'{i+1}',
+            x / step, y / step, f'{i+1}',
             color='yellow', fontsize=14, weight='bold',
             ha='center', va='center',
             bbox=dict(facecolor='black', alpha=0.5, pad=2)
@@ -62,39 +89,10 @@ def show_results(
     ax5.set_title('Numbered Parts')
     ax5.axis('off')
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     if return_fig:
         return fig
 
-    plt.close(fig)
-
-def save_numbered_parts_with_metrics(substrate, part_masks, blackness, file_or_buffer):
-    combined = np.zeros_like(part_masks[0], dtype=int)
-    for i, pm in enumerate(part_masks):
-        combined[pm] = i + 1
-
-    regions = regionprops(combined)
-    del combined  # prevent memory retention
-
-    fig, ax = plt.subplots(figsize=(6, 6))
-    ax.imshow(substrate)
-    ax.axis("off")
-
-    for i, region in enumerate(regions):
-        y, x = region.centroid
-        ax.text(
-            x, y, f"{i+1}",
-            color="yellow", fontsize=14, weight="bold",
-            ha="center", va="center",
-            bbox=dict(facecolor="black", alpha=0.5, pad=2)
-        )
-
-    ax.set_title("Numbered Parts (saved)")
-
-    if isinstance(file_or_buffer, str):
-        fig.savefig(file_or_buffer, dpi=300, bbox_inches="tight")
-    else:
-        fig.savefig(file_or_buffer, format="jpg", dpi=300, bbox_inches="tight")
-
-    plt.close(fig)
\ No newline at end of file
+    if pyplot:
+        plt.close(fig)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules live flat in src/ and import each other by name, as when the programs are run from src/
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(SRC_DIR), 'sample_input_image.jpg')
@@ -0,0 +1,64 @@
+import warnings
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+from skimage.color import rgb2gray
+from skimage.feature import canny
+from skimage import morphology
+from conftest import SAMPLE_IMAGE
+from utils import load_image
+from segmentation import COARSE_PERCENTILE, HOLE_AREA, block_mean
+from binary_morphology import dilate_disk, close_disk, fill_holes
+
+def radii(scale):
+    """
+    The radii of the dilations and closing _segment_gray uses on an image downscaled scale times
+    """
+    return max(1, round(6 / scale)), max(1, round(2 / scale)), max(1, round(4 / scale))
+
+def random_masks(seed, shape=(160, 200)):
+    """
+    Masks like the ones _segment_gray sees: sparse edge-like pixels, and blobs with holes from a smoothed noise
+    """
+    rng = np.random.default_rng(seed)
+    sparse = rng.random(shape) < 0.02
+    blobs = ndi.gaussian_filter(rng.random(shape), 4) > 0.5
+    return [sparse, blobs, blobs ^ sparse]
+
+def sample_masks(scale):
+    """
+    The coarse mask and the edges of the sample image at a downscale, as _segment_gray computes them
+    """
+    gray = rgb2gray(load_image(SAMPLE_IMAGE))
+    coarse_thresh = np.percentile(gray, COARSE_PERCENTILE)
+    small = block_mean(gray, scale)
+    coarse_mask = small < coarse_thresh
+    return [coarse_mask, canny(small, sigma=max(0.5, 2 / scale)) & dilate_disk(coarse_mask, radii(scale)[0])]
+
+def reference_fill(mask, max_border_hole):
+    with warnings.catch_warnings():
+        # the area_threshold keyword is deprecated in the newer skimage
+        warnings.simplefilter('ignore', FutureWarning)
+        return morphology.remove_small_holes(ndi.binary_fill_holes(mask), area_threshold=max_border_hole)
+
+def check_against_reference(mask, scale):
+    for radius in sorted(set(radii(scale)) | {1, 2, 4, 6}):
+        footprint = morphology.disk(radius)
+        assert np.array_equal(dilate_disk(mask, radius), morphology.dilation(mask, footprint))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            closed = morphology.binary_closing(mask, footprint)
+        assert np.array_equal(close_disk(mask, radius), closed)
+    max_border_hole = max(1, HOLE_AREA // scale**2)
+    assert np.array_equal(fill_holes(mask, max_border_hole=max_border_hole), reference_fill(mask, max_border_hole))
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('scale', [1, 2, 4, 8])
+def test_random_masks_match_skimage(seed, scale):
+    for mask in random_masks(seed):
+        check_against_reference(mask, scale)
+
+@pytest.mark.parametrize('scale', [4, 8])
+def test_sample_masks_match_skimage(scale):
+    for mask in sample_masks(scale):
+        check_against_reference(mask, scale)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+from analysis_core import analyze_image_core, analyze_image_core_batch
+
+CENTERS = [(200, 150), (200, 450), (200, 750), (430, 300), (430, 600)]
+RADIUS = 80
+# a clean part reads no rust but for the odd noisy pixel
+MAX_CLEAN_RUST = 1e-3
+
+def clean_parts_image(seed=0):
+    """
+    Clean dark round parts on a light background: their outline is blurred as the optics blur it, so its pixels
+    mix the part with the background, and each part has a flat specular highlight
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:600, :900]
+    parts = np.zeros((600, 900), dtype=bool)
+    for cy, cx in CENTERS:
+        parts |= (yy - cy)**2 + (xx - cx)**2 <= RADIUS**2
+    image = np.where(parts[..., None], [38.0, 40.0, 42.0], [236.0, 234.0, 230.0])
+    image = ndi.gaussian_filter(image, sigma=(1.2, 1.2, 0)) + rng.normal(0, 1.5, image.shape)
+    # about 8% of each part, so that the outline is not in the top 5% of its L* left out as highlights
+    for cy, cx in CENTERS:
+        image[cy - 40:cy - 20, cx - 40:cx + 40] = 250
+    return np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+@pytest.mark.parametrize('normalized', [True, False], ids=['core', 'batch'])
+def test_clean_parts_read_no_rust(normalized):
+    image = clean_parts_image()
+    if normalized:
+        df, _, _ = analyze_image_core(image, return_fig=False, annotate=False)
+    else:
+        df = analyze_image_core_batch(image)
+    assert len(df) == len(CENTERS)
+    assert (df['Red Rust Fraction'] == 0).all()
+    assert (df['White Rust Fraction'] < MAX_CLEAN_RUST).all()
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from color_processing import compute_metrics, compute_metrics_batched, split_lab_parts
+
+# tolerance of compute_metrics_batched against compute_metrics, as its docstring states
+RTOL = {np.float64: 1e-9, np.float32: 1e-6}
+
+def random_parts(rng, dtype, n_parts=12):
+    """
+    L, a, b of random parts in the Lab ranges of the pipeline: continuous values, values rounded so that many tie
+    (at the percentiles too), and parts of only a handful of distinct values
+    """
+    sizes = rng.integers(2, 4000, n_parts)
+    L = rng.uniform(0, 100, sizes.sum())
+    a = rng.normal(0, 12, sizes.sum())
+    b = rng.normal(5, 12, sizes.sum())
+    bounds = np.cumsum([0] + list(sizes))
+    for i, (s, e) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if i % 3 == 1:
+            L[s:e] = np.round(L[s:e])
+            a[s:e] = np.round(a[s:e])
+        elif i % 3 == 2:
+            L[s:e] = rng.choice([40.0, 78.0, 85.0, 97.0], e - s)
+    return L.astype(dtype), a.astype(dtype), b.astype(dtype), list(sizes)
+
+@pytest.mark.parametrize('with_interior', [False, True], ids=['all pixels', 'interior'])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('seed', range(5))
+def test_batched_matches_compute_metrics(dtype, seed, with_interior):
+    rng = np.random.default_rng(seed)
+    L, a, b, sizes = random_parts(rng, dtype)
+    interior, interiors = None, None
+    if with_interior:
+        interior = rng.random(len(L)) < 0.8
+        interiors = [flags for flags, _, _ in split_lab_parts(interior, a, b, sizes)]
+    expected = compute_metrics(split_lab_parts(L, a, b, sizes), interiors=interiors)
+    # compute_metrics_batched partitions its own copies, the inputs stay as they were
+    batched = compute_metrics_batched(L, a, b, sizes, interior=interior)
+    # the absolute tolerance is relative to the L* scale, for the medians and shifts close to 0
+    for name, want, got in zip(('blackness', 'color_shift', 'a_shift', 'b_shift', 'gloss'), expected, batched):
+        np.testing.assert_allclose(got, want, rtol=RTOL[dtype], atol=RTOL[dtype] * 100, err_msg=name)
+    for name, want, got in zip(('red_rust', 'white_rust'), expected[5:], batched[5:]):
+        np.testing.assert_array_equal(got, want, err_msg=name)
+
+@pytest.mark.parametrize('L_part', [np.full(50, 62.0), np.array([62.0])], ids=['all equal', 'single pixel'])
+def test_part_without_diffuse_pixels(L_part):
+    # every L value is the 95th percentile itself: no pixel is diffuse or a highlight
+    L = np.concatenate([np.linspace(20, 90, 200), L_part])
+    a = np.zeros_like(L)
+    b = np.ones_like(L)
+    sizes = [200, len(L_part)]
+    with pytest.raises((IndexError, ValueError)):
+        compute_metrics(split_lab_parts(L, a, b, sizes))
+    blackness, color_shift, a_shift, b_shift, gloss, red_rust, white_rust = compute_metrics_batched(L, a, b, sizes)
+    for values in (blackness, color_shift, a_shift, b_shift, red_rust, white_rust):
+        assert np.isfinite(values[0])
+        assert np.isnan(values[1])
+    assert gloss[1] == 0
@@ -0,0 +1,33 @@
+import json
+import os
+import pandas as pd
+import multi_file
+from PIL import Image
+from multi_file import analyze_images_in_directory, load_manifest, MANIFEST_NAME
+from synthetic_images import make_lightbox_image
+
+N_PARTS = 3
+
+def test_resume_after_a_cut_manifest_line(tmp_path, monkeypatch):
+    images, output = tmp_path / 'images', str(tmp_path / 'output')
+    images.mkdir()
+    for i, name in enumerate(['a.jpg', 'b.jpg']):
+        Image.fromarray(make_lightbox_image(0.5, n_parts=N_PARTS, seed=i)).save(images / name, quality=92)
+    analyze_images_in_directory(str(images), output, per_image_csv=False)
+
+    # a run interrupted while writing the record of b.jpg
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    with open(manifest_path, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    with open(manifest_path, 'wb') as f:
+        f.write(b''.join(lines[:-1]) + lines[-1][:len(lines[-1]) // 2])
+    assert list(load_manifest(output)) == ['a.jpg']
+
+    # the partial line is longer than a block, so it is looked back over a block at a time
+    monkeypatch.setattr(multi_file, 'MANIFEST_BLOCK', 8)
+    analyze_images_in_directory(str(images), output, per_image_csv=False, resume=True)
+    with open(manifest_path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['file'] for r in records] == ['a.jpg', 'b.jpg']
+    df = pd.read_csv(os.path.join(output, 'combined_metrics.csv'))
+    assert list(df['group']) == ['a'] * N_PARTS + ['b'] * N_PARTS
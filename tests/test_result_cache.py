@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import pandas as pd
+import result_cache
+from result_cache import store, lookup, evict_lru, EVICT_TO
+
+def cache_size(cache_dir):
+    return sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+
+def test_store_keeps_cap_without_listing_every_time(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    df = pd.DataFrame({'Part #': np.arange(1, 11), 'Blackness': np.linspace(10, 20, 10)})
+    labels = np.repeat(np.arange(11, dtype=np.uint16), 40).reshape(20, 22)
+    scans = []
+
+    def counted_evict(*args, **kwargs):
+        scans.append(args)
+        return evict_lru(*args, **kwargs)
+
+    monkeypatch.setattr(result_cache, '_cache_sizes', {})
+    monkeypatch.setattr(result_cache, 'evict_lru', counted_evict)
+    store(cache_dir, 'first', df, labels)
+    max_bytes = 40 * cache_size(cache_dir)
+    for i in range(400):
+        store(cache_dir, f'key{i}', df, labels, max_bytes=max_bytes)
+        assert cache_size(cache_dir) <= max_bytes
+    # the directory is listed on the first store, then once per (1 - EVICT_TO) of the cap stored: every 4 entries
+    assert 8 <= len(scans) <= 400 // 4 + 1
+    # the most recent entries are kept
+    assert lookup(cache_dir, 'key399', need_labels=True)[0] is not None
+    assert lookup(cache_dir, 'key0')[0] is None
+
+def test_processes_sharing_the_cache_overshoot_within_bound(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    df = pd.DataFrame({'Part #': np.arange(1, 11), 'Blackness': np.linspace(10, 20, 10)})
+    store(cache_dir, 'first', df)
+    max_bytes = 40 * cache_size(cache_dir)
+    # each worker process keeps its own running total, all of them starting from the same nearly empty cache
+    n_processes = 4
+    running_totals = [{} for _ in range(n_processes)]
+    bound = max_bytes * (1 + (n_processes - 1) * (1 - EVICT_TO))
+    largest = 0
+    for i in range(400):
+        monkeypatch.setattr(result_cache, '_cache_sizes', running_totals[i % n_processes])
+        store(cache_dir, f'key{i}', df, max_bytes=max_bytes)
+        largest = max(largest, cache_size(cache_dir))
+    assert max_bytes < largest <= bound
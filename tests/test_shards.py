@@ -0,0 +1,80 @@
+import json
+import os
+import pandas as pd
+import pytest
+from PIL import Image
+from multi_file import analyze_images_in_directory, list_images, load_manifest
+from shards import merge_shards, parse_shard
+from synthetic_images import make_lightbox_image
+
+N_PARTS = 3
+
+def write_image(path, seed):
+    Image.fromarray(make_lightbox_image(0.5, n_parts=N_PARTS, seed=seed)).save(path, quality=92)
+
+@pytest.fixture
+def image_tree(tmp_path):
+    images = tmp_path / 'images'
+    (images / 'lot2').mkdir(parents=True)
+    for i, name in enumerate(['a.jpg', 'b.jpg', 'lot2/c.jpg', 'lot2/d.jpg']):
+        write_image(images / name, seed=i)
+    return images
+
+def combined(output_directory):
+    return pd.read_csv(os.path.join(output_directory, 'combined_metrics.csv'), dtype={'group': str})
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    assert parse_shard((0, 2)) == (0, 2)
+    for shard in ('4/4', '1', 'a/b', (2, 2)):
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+def test_shards_split_the_tree(image_tree):
+    everything = list_images(str(image_tree), recursive=True)
+    shards = [list_images(str(image_tree), recursive=True, shard=(i, 3)) for i in range(3)]
+    assert sorted(f for shard in shards for f in shard) == everything
+    assert len(everything) == 4
+
+def test_merge_keeps_one_analysis_per_image(image_tree, tmp_path):
+    shard_dirs = []
+    for i in range(2):
+        shard_dir = str(tmp_path / f'shard-{i}')
+        analyze_images_in_directory(str(image_tree), shard_dir, recursive=True, shard=(i, 2), per_image_csv=False)
+        shard_dirs.append(shard_dir)
+    # a shard run twice over the same images (ex. on a second machine by mistake) duplicates its images
+    analyze_images_in_directory(str(image_tree), str(tmp_path / 'again'), recursive=True, shard=(0, 2), per_image_csv=False)
+    shard_dirs.append(str(tmp_path / 'again'))
+
+    merged_dir = str(tmp_path / 'merged')
+    report = merge_shards(shard_dirs, merged_dir, image_directory=str(image_tree))
+    rows = combined(merged_dir)
+    assert report['images'] == 4 and report['missing'] == [] and report['failed'] == []
+    assert report['duplicates'] == len(list_images(str(image_tree), recursive=True, shard=(0, 2)))
+    assert sorted(rows['group'].unique()) == ['a', 'b', 'lot2/c', 'lot2/d']
+    assert len(rows) == 4 * N_PARTS
+    assert set(load_manifest(merged_dir)) == set(list_images(str(image_tree), recursive=True))
+
+def test_resume_after_change_keeps_latest_analysis(image_tree, tmp_path):
+    output = str(tmp_path / 'out')
+    analyze_images_in_directory(str(image_tree), output, recursive=True, per_image_csv=False)
+    before = combined(output)
+
+    # the last image changes and is analyzed again, its new rows follow its old ones in the combined CSV
+    changed = image_tree / 'lot2' / 'd.jpg'
+    write_image(changed, seed=10)
+    analyze_images_in_directory(str(image_tree), output, recursive=True, resume=True, per_image_csv=False)
+    appended = combined(output)
+    assert len(appended) == len(before) + N_PARTS
+    assert list(appended['group'].iloc[-2 * N_PARTS:]) == ['lot2/d'] * (2 * N_PARTS)
+
+    merged_dir = str(tmp_path / 'merged')
+    report = merge_shards([output], merged_dir)
+    rows = combined(merged_dir)
+    assert len(rows) == 4 * N_PARTS
+    latest = rows[rows['group'] == 'lot2/d'].reset_index(drop=True)
+    expected = appended.iloc[-N_PARTS:].reset_index(drop=True)
+    pd.testing.assert_frame_equal(latest, expected, check_dtype=False)
+    assert report['rows'] == len(rows)
+    with open(os.path.join(merged_dir, 'merge_report.json')) as f:
+        assert json.load(f)['images'] == 4
@@ -0,0 +1,28 @@
+import numpy as np
+from conftest import SAMPLE_IMAGE
+from analysis_core import analyze_image_core_batch, MIN_AREA
+from utils import load_image
+from segmentation import (threshold_parts, extract_part_regions, sort_regions_l2r, regions_to_masks, iter_part_masks,
+                          part_interior)
+from color_processing import (convert_to_lab, get_lab_parts, compute_metrics, sampled_background_mean, background_lightness,
+                              BG_LEVEL_STEP, RUST_EDGE_MARGIN)
+
+COLUMNS = ['Blackness', 'Color Shift', 'Median a*', 'Median b*', 'Gloss Factor',
+           'Red Rust Fraction', 'White Rust Fraction']
+
+def test_part_pixel_lab_matches_full_frame():
+    # reference: the whole frame converted to Lab, then split into parts
+    img = load_image(SAMPLE_IMAGE)
+    gray, binary, _ = threshold_parts(img)
+    labels, regions = extract_part_regions(binary, min_area=MIN_AREA)
+    part_masks = regions_to_masks(labels, sort_regions_l2r(regions))
+    grid = (slice(None, None, BG_LEVEL_STEP), slice(None, None, BG_LEVEL_STEP))
+    bg_L = background_lightness(sampled_background_mean(img[grid], gray[grid], part_masks.labels[grid] > 0))
+    L, a, b = convert_to_lab(img)
+    interiors = [part_interior(pm, RUST_EDGE_MARGIN)[pm] for _, pm in iter_part_masks(part_masks)]
+    expected = compute_metrics(get_lab_parts(L, a, b, part_masks), bg_L=bg_L, interiors=interiors)
+
+    df = analyze_image_core_batch(SAMPLE_IMAGE)
+    assert len(df) == len(part_masks.slices) > 0
+    for column, values in zip(COLUMNS, expected):
+        np.testing.assert_allclose(df[column].to_numpy(), values, rtol=0, atol=1e-12, err_msg=column)
@@ -0,0 +1,22 @@
+import hashlib
+import io
+from PIL import Image
+from multi_file import _analyze_file
+from synthetic_images import make_lightbox_image
+
+EMPTY_DIGEST = hashlib.sha256(b'').hexdigest()
+
+def test_memory_budget_batch_hashes_whole_file(tmp_path):
+    digests = []
+    for seed in (0, 1):
+        path = tmp_path / f'tray{seed}.jpg'
+        Image.fromarray(make_lightbox_image(0.5, n_parts=3, seed=seed)).save(path, quality=92)
+        data = path.read_bytes()
+        # the read-ahead stage hands over the bytes of the file, which the tiled analysis reads to the end
+        df, error, _, _ = _analyze_file(str(path), image_input=io.BytesIO(data), hash_image=True,
+                                        downscale=4, memory_budget=16 * 1024**2)
+        assert error is None
+        assert df.attrs['image_hash'] == hashlib.sha256(data).hexdigest()
+        digests.append(df.attrs['image_hash'])
+    assert EMPTY_DIGEST not in digests
+    assert digests[0] != digests[1]